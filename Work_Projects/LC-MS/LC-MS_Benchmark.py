@@ -0,0 +1,256 @@
+# LC-MS_Benchmark.py
+"""Benchmarks for LC-MS_Parser. The "pca" command times the PCA backends on
+randomly generated binned cohorts and compares the variance that each one
+explains with that of the exact backend. The "pipeline" command writes a
+synthetic cohort of parser "1" or "2" .csv files and times the parse, bin,
+combine, and PCA stages separately, along with their peak memory in a
+separate traced run, and can compare the results with a stored baseline."""
+
+import os
+import csv
+import sys
+import json
+import logging
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import importlib.util
+import numpy as np
+from scipy import sparse as sp
+
+# Load LC-MS_Parser.py, whose name is not a valid module name
+spec = importlib.util.spec_from_file_location("LC_MS_Parser", os.path.join(os.path.dirname(os.path.abspath(__file__)), "LC-MS_Parser.py"))
+lcms = importlib.util.module_from_spec(spec)
+# Register the module so that its functions can be pickled for worker processes
+sys.modules[spec.name] = lcms
+spec.loader.exec_module(lcms)
+
+
+
+def random_cohort(samples, features, density, seed=0):
+    """Returns a samples x features sparse matrix of random binned
+    counts with the given fraction of nonzero bins. A few shared
+    patterns are mixed in so that the leading principal components
+    mean something."""
+    rng = np.random.default_rng(seed)
+    noise = sp.random(samples, features, density=density, format="csr", random_state=seed)
+    patterns = sp.random(4, features, density=density, format="csr", random_state=seed+1)
+    weights = sp.csr_matrix(rng.uniform(0, 5, (samples, 4)))
+    return (noise + weights @ patterns).tocsr()
+
+
+
+def explained_variance(X, projected_data):
+    """Returns the fraction of the total variance of the rows of X that
+    is kept by the given projection of the centered rows."""
+    means = np.asarray(X.mean(axis=0)).ravel()
+    total = X.multiply(X).sum() - X.shape[0]*means.dot(means)
+    return np.sum(projected_data**2)/total
+
+
+
+def run(samples, features, density, d, chunk_size, n_iter, n_oversamples):
+    """Prints the runtime and explained variance of each backend on one
+    random cohort."""
+    X = random_cohort(samples, features, density)
+    print("{} samples x {} bins, {} nonzero, d = {}".format(samples, features, X.nnz, d))
+    exact_variance = None
+    for backend in ["exact", "randomized", "incremental"]:
+        start = time.perf_counter()
+        projected_data = lcms.LC_MS_PCA(X, d, None, None, pre_binned=True, backend=backend, n_iter=n_iter,
+                                        n_oversamples=n_oversamples, chunk_size=chunk_size, random_state=0)
+        seconds = time.perf_counter() - start
+        variance = explained_variance(X, projected_data)
+        if exact_variance is None:
+            exact_variance = variance
+        print("    {:<12} {:>8.3f} s   explained variance {:.4f} ({:.2%} of exact)".format(
+            backend, seconds, variance, variance/exact_variance))
+
+
+
+def write_parser_1(filename, compounds, rng):
+    """Writes the given compounds to a .csv file in the style of parser "1",
+    with a header row for each compound followed by a row for each of its
+    peaks. Each compound is a tuple (RT-start, RT-end, m/z, number of peaks)."""
+    with open(filename, "w", newline="") as file:
+        csvwriter = csv.writer(file)
+        for i, (RT_start, RT_end, mz, n_peaks) in enumerate(compounds):
+            csvwriter.writerow(["#+ESI MFE Spectrum (rt: {:.3f}-{:.3f} min) Cpd {}: {:.3f}".format(
+                RT_start, RT_end, i+1, (RT_start+RT_end)/2)])
+            csvwriter.writerow(["#Point", "X(Thompsons)", "Y(Counts)"])
+            abundance = rng.uniform(1e3, 1e5)
+            for k in range(n_peaks):
+                csvwriter.writerow([k, "{:.4f}".format(mz + 1.003*k), "{:.1f}".format(abundance/(k+1))])
+
+
+def write_parser_2(filename, compounds, rng):
+    """Writes the C12 peak of each of the given compounds to a .csv file in
+    the style of parser "2", with three header rows and one row per
+    compound."""
+    with open(filename, "w", newline="") as file:
+        csvwriter = csv.writer(file)
+        for _ in range(3):
+            csvwriter.writerow(["header"]*51)
+        for RT_start, RT_end, mz, n_peaks in compounds:
+            row = [""]*51
+            row[28] = "{:.4f}".format(mz)
+            row[36] = "{:.1f}".format(rng.uniform(1e3, 1e5))
+            row[48] = "{:.3f}".format((RT_start+RT_end)/2)
+            row[50] = "{:.3f}".format(RT_start)
+            row[33] = "{:.3f}".format(RT_end)
+            csvwriter.writerow(row)
+
+
+def synthetic_cohort(directory, parser, files, compounds, max_peaks, seed=0):
+    """Writes "files" .csv files of the given parser style to directory and
+    returns their names. The files share a pool of compounds, each of which
+    is missing from a file 15% of the time and is jittered slightly in m/z
+    and RT, so that combining the files has real matching to do."""
+    rng = np.random.default_rng(seed)
+    RT_start = rng.uniform(0, 30, compounds)
+    mz = rng.uniform(100, 900, compounds)
+    n_peaks = rng.integers(1, max_peaks+1, compounds)
+    write = write_parser_1 if parser == "1" else write_parser_2
+    filenames = []
+    for i in range(files):
+        kept = np.nonzero(rng.random(compounds) >= 0.15)[0]
+        shift = rng.normal(0, 0.05, len(kept))
+        file_compounds = [(RT_start[j] + shift[k], RT_start[j] + shift[k] + 0.5, 
+                           mz[j] + rng.normal(0, 0.002), n_peaks[j]) for k, j in enumerate(kept)]
+        filenames.append(os.path.join(directory, "run_{:04d}.csv".format(i)))
+        write(filenames[-1], file_compounds, rng)
+    return filenames
+
+
+def measure(func, *args, reset=None):
+    """Returns the result of func(*args) along with the seconds it took and
+    the peak memory in MB that it allocated. The seconds come from one run
+    and the peak memory from a second run traced by tracemalloc, since
+    tracing every allocation slows func down. If given, reset is called
+    before each run so that the second run does not reuse anything cached
+    by the first."""
+    if reset is not None:
+        reset()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak/2**20
+
+
+def run_pipeline(parser, files, compounds, max_peaks, mz_bin_width, RT_bin_width, d, repeat=3, seed=0):
+    """Returns a dictionary of the seconds and peak memory of each stage of
+    the pipeline on one synthetic cohort, keeping the fastest of "repeat"
+    runs of the whole pipeline to reduce noise."""
+    directory = tempfile.mkdtemp(prefix="lcms_benchmark_")
+    try:
+        filenames = synthetic_cohort(directory, parser, files, compounds, max_peaks, seed)
+        mz_bins = np.arange(100, 905, mz_bin_width)
+        RT_bins = np.arange(0, 31, RT_bin_width)
+        outfile = os.path.join(directory, "combined.out")
+        
+        def reset():
+            # Drop the parsed files, binned counts, and combined file of the last run so every run starts cold
+            lcms.parse_cache.clear()
+            lcms.bin_cache.clear()
+            if os.path.exists(outfile):
+                os.remove(outfile)
+        
+        stages = {}
+        for _ in range(repeat):
+            runs, *parse = measure(lambda: [lcms.LC_MSData(filename, parser) for filename in filenames], reset=reset)
+            binned_data, *binning = measure(lcms.LC_MS_binner, runs, mz_bins, RT_bins, 1.0, "sum", None, False, True, 
+                                            reset=reset)
+            _, *combine = measure(lcms.MFE_getter, filenames, outfile, "MFE", True, 0.01, 1.0, parser, reset=reset)
+            _, *pca = measure(lcms.LC_MS_PCA, binned_data, d, None, None, 1.0, "sum", None, True)
+            for stage, (seconds, peak) in zip(["parse", "bin", "combine", "pca"], [parse, binning, combine, pca]):
+                if stage not in stages or seconds < stages[stage]["seconds"]:
+                    stages[stage] = {"seconds": seconds, "peak_mb": peak}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return stages
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of each stage from the baseline and returns whether
+    any stage took more than (1 + tolerance) times as long or as much memory
+    as it did in the baseline."""
+    regressed = False
+    for name, stages in results.items():
+        for stage, values in stages.items():
+            old = baseline.get(name, {}).get(stage)
+            if old is None:
+                continue
+            for key in ["seconds", "peak_mb"]:
+                ratio = values[key]/old[key] if old[key] > 0 else 1.0
+                flag = ratio > 1 + tolerance
+                regressed |= flag
+                print("    {:<10} {:<8} {:<8} {:>10.3f} -> {:>10.3f} ({:+.1%}){}".format(
+                    name, stage, key, old[key], values[key], ratio-1, "  REGRESSION" if flag else ""))
+    return regressed
+
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    
+    pca_parser = subparsers.add_parser("pca", help="Compare the PCA backends on random binned cohorts.")
+    pca_parser.add_argument("--samples", type=int, nargs="+", default=[100, 500],
+                            help="The numbers of samples in the cohorts.")
+    pca_parser.add_argument("--features", type=int, nargs="+", default=[20000, 100000],
+                            help="The numbers of bins in the cohorts, one for each number of samples.")
+    pca_parser.add_argument("--density", type=float, default=0.01, help="The fraction of nonzero bins.")
+    pca_parser.add_argument("-d", type=int, default=2, help="The number of principal components.")
+    pca_parser.add_argument("--chunk-size", type=int, default=100, help="The chunk size of the incremental backend.")
+    pca_parser.add_argument("--n-iter", type=int, default=4, help="The power iterations of the randomized backend.")
+    pca_parser.add_argument("--n-oversamples", type=int, default=10, help="The oversampling of the randomized backend.")
+    
+    pipeline_parser = subparsers.add_parser("pipeline", help="Time each stage of the pipeline on synthetic files.")
+    pipeline_parser.add_argument("--parsers", nargs="+", default=["1", "2"], choices=["1", "2"],
+                                 help="The file styles to benchmark.")
+    pipeline_parser.add_argument("--files", type=int, default=20, help="The number of files in the cohort.")
+    pipeline_parser.add_argument("--compounds", type=int, default=2000, help="The number of compounds per file.")
+    pipeline_parser.add_argument("--max-peaks", type=int, default=4, help="The most isotope peaks per compound.")
+    pipeline_parser.add_argument("--mz-bin-width", type=float, default=1.0, help="The width of the m/z bins.")
+    pipeline_parser.add_argument("--RT-bin-width", type=float, default=1.0, help="The width of the RT bins.")
+    pipeline_parser.add_argument("-d", type=int, default=2, help="The number of principal components.")
+    pipeline_parser.add_argument("--repeat", type=int, default=3, help="The number of runs to take the fastest of.")
+    pipeline_parser.add_argument("--output", help="A .json file to write the results to.")
+    pipeline_parser.add_argument("--baseline", help="A .json file of earlier results to compare with.")
+    pipeline_parser.add_argument("--tolerance", type=float, default=0.2,
+                                 help="The fractional slowdown or memory growth counted as a regression.")
+    args = arg_parser.parse_args()
+    # Show the progress that LC-MS_Parser logs
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    
+    if args.command == "pca":
+        for samples, features in zip(args.samples, args.features):
+            run(samples, features, args.density, args.d, args.chunk_size, args.n_iter, args.n_oversamples)
+    else:
+        results = {}
+        for parser in args.parsers:
+            name = "parser_" + parser
+            results[name] = run_pipeline(parser, args.files, args.compounds, args.max_peaks, 
+                                         args.mz_bin_width, args.RT_bin_width, args.d, args.repeat)
+            for stage, values in results[name].items():
+                print("{:<10} {:<8} {:>8.3f} s {:>10.1f} MB".format(name, stage, values["seconds"], values["peak_mb"]))
+        config = {key: value for key, value in vars(args).items() if key not in ["command", "output", "baseline", "tolerance"]}
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump({"config": config, "results": results}, file, indent=2)
+        if args.baseline:
+            with open(args.baseline, "r") as file:
+                baseline = json.load(file)
+            if baseline.get("config") != config:
+                print("Warning: the baseline was made with different settings")
+            print("Compared with {}:".format(args.baseline))
+            if compare(results, baseline["results"], args.tolerance):
+                sys.exit(1)
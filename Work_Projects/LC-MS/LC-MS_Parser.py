@@ -3,286 +3,1134 @@
 
 import os
 import re
+import sys
 import csv
+import time
+import weakref
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import zipfile
+from array import array
 import numpy as np
 import pandas as pd
 from scipy import linalg as la
 from scipy.sparse import linalg as spla
 from scipy.sparse import csr_matrix
+from scipy import sparse as sp
 from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from itertools import permutations as perm
+from itertools import repeat
+from itertools import count
+from collections import OrderedDict
+from functools import partial, wraps
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.decomposition import KernelPCA
+from sklearn.decomposition import IncrementalPCA
 from sklearn.model_selection import GridSearchCV
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingGridSearchCV
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.pipeline import Pipeline
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 
 
-def xls_to_csv(path="C:\\Research\Data"):
+# Progress messages from the tracking arguments are logged at the INFO level, 
+# and the details of discarded values at the DEBUG level. The application 
+# decides where they go, for example with logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("LC_MS_Parser")
+logger.addHandler(logging.NullHandler())
+
+
+def _progress(tracking, message, *args):
+    """Logs a progress message at the INFO level if tracking is on."""
+    if tracking:
+        logger.info(message, *args)
+
+
+
+class Profiler():
+    """Collects the time, the counters, and optionally the peak memory of 
+    each stage of an analysis while it is active. Use it as a context 
+    manager:
+        with Profiler() as profiler:
+            LC_MS_PCA(data, 2, mz_bins, RT_bins)
+        print(profiler.report())
+    When no Profiler is active, the instrumented functions only check 
+    that there is none. Stages run in worker processes are not seen.
+    
+    Attributes:
+        stages (OrderedDict): Maps the name of each stage to a dictionary 
+            of its number of calls, total seconds, peak traced memory in 
+            MB (if memory=True), and summed counters, such as the number 
+            of peaks read, discarded and binned.
+        callback (function): Called as callback(name, seconds, counters, 
+            peak_mb) at the end of each call of a stage, with the values 
+            for that call. Each call is also logged at the DEBUG level.
+        memory (bool): Whether or not to trace memory with tracemalloc, 
+            which slows down allocation-heavy code."""
+    
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory = memory
+        self.stages = OrderedDict()
+        # The open stages, innermost last, as [name, start time, counters, peak bytes]
+        self._open = []
+        self._previous = None
+        self._started_tracing = False
+    
+    
+    def __enter__(self):
+        global _profiler
+        self._previous = _profiler
+        _profiler = self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        global _profiler
+        _profiler = self._previous
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+    
+    
+    def stage(self, name):
+        """Returns a context manager that times the code inside it as a 
+        call of the stage with the given name."""
+        return _Stage(self, name)
+    
+    
+    def count(self, **counters):
+        """Adds the given counts to the counters of the innermost stage."""
+        if self._open:
+            open_counters = self._open[-1][2]
+            for key, value in counters.items():
+                open_counters[key] = open_counters.get(key, 0) + int(value)
+    
+    
+    def _start(self, name):
+        if self.memory:
+            # Credit the peak so far to the enclosing stage before measuring this one
+            if self._open:
+                self._open[-1][3] = max(self._open[-1][3], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._open.append([name, time.perf_counter(), {}, 0])
+    
+    
+    def _stop(self):
+        name, start, counters, peak = self._open.pop()
+        seconds = time.perf_counter() - start
+        peak_mb = None
+        if self.memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            peak_mb = peak/2**20
+            if self._open:
+                self._open[-1][3] = max(self._open[-1][3], peak)
+        record = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_mb": None, "counters": {}})
+        record["calls"] += 1
+        record["seconds"] += seconds
+        if peak_mb is not None:
+            record["peak_mb"] = peak_mb if record["peak_mb"] is None else max(record["peak_mb"], peak_mb)
+        for key, value in counters.items():
+            record["counters"][key] = record["counters"].get(key, 0) + value
+        logger.debug("%s took %.3f s %s", name, seconds, counters)
+        if self.callback is not None:
+            self.callback(name, seconds, counters, peak_mb)
+    
+    
+    def report(self):
+        """Returns a table of the recorded stages as a string."""
+        lines = []
+        for name, record in self.stages.items():
+            line = "{:<24} {:>6} calls {:>10.3f} s".format(name, record["calls"], record["seconds"])
+            if record["peak_mb"] is not None:
+                line += " {:>10.1f} MB".format(record["peak_mb"])
+            for key, value in record["counters"].items():
+                line += "  {}={}".format(key, value)
+            lines.append(line)
+        return "\n".join(lines)
+
+
+
+class _Stage():
+    """The context manager returned by Profiler.stage."""
+    
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+    
+    
+    def __enter__(self):
+        self.profiler._start(self.name)
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.profiler._stop()
+        return False
+
+
+# The active Profiler, if any
+_profiler = None
+_NO_STAGE = nullcontext()
+
+
+def _stage(name):
+    """Returns a context manager that times the code inside it as the 
+    given stage of the active Profiler, or one that does nothing."""
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.stage(name)
+
+
+def _profiled(name):
+    """Decorates a function so that each call of it is a stage of the 
+    active Profiler."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+
+def _xls_out(filename, directory, out_dir):
+    """Returns the name of the .csv file in out_dir for the given .xls 
+    file in the directory "directory", which is at the same path 
+    relative to out_dir as the .xls file is to the directory."""
+    relative = os.path.relpath(os.path.splitext(filename)[0]+".csv", directory)
+    return os.path.join(out_dir, relative)
+
+
+
+def _convert_xls(filename, parser, directory, out_dir, cache_dir):
+    """Converts the .xls file with the given name in the directory 
+    "directory" to a .csv file of the same base name and relative path 
+    in out_dir and returns the name of the .csv file. If parser is not 
+    None, the .csv file is also parsed into the cache in cache_dir so 
+    that LC_MS_getter does not have to parse it again."""
+    out = _xls_out(filename, directory, out_dir)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    df = pd.read_excel(filename, "Sheet1")
+    # Write to a temporary file first so that a partial .csv file is never read
+    temp_file = out + ".{}.tmp".format(os.getpid())
+    df.to_csv(temp_file, index=False)
+    os.replace(temp_file, out)
+    if parser is not None:
+        _cached_LC_MSData(out, parser, cache_dir)
+    return out
+
+
+
+def xls_to_csv(path="C:\\Research\Data", out_dir=".", workers=None, parser=None, tracking=False):
     """Take every .xls file in the given directory and change it to 
-    a .csv file in the current directory."""
+    a .csv file in the directory out_dir, which defaults to the current 
+    directory. Files in subdirectories are written to the same 
+    subdirectories of out_dir, so files of the same name in different 
+    subdirectories do not overwrite each other. Files whose .csv file 
+    is newer than the .xls file are skipped. If workers is greater than 
+    1, the files are converted in a pool of that many processes. If 
+    parser is given, each new .csv file is also parsed with that parser 
+    into the cache that LC_MS_getter reads for out_dir. Returns the 
+    names of the new .csv files."""
     # Get the path from which the files are to be taken
     directory = os.path.abspath(path)
-    # Get and parse all of the files
+    # Find the files that are missing a .csv file or have changed since it was made
+    filenames = []
     for root, dirs, files in os.walk(directory):
-        for filename in files:
+        dirs.sort()
+        for filename in sorted(files):
             if filename.endswith(".xls"):
-                out = filename.split('.')[0]+'.csv'
-                df = pd.read_excel(path+"\\"+filename, 'Sheet1')
-                df.to_csv(out, index=False)
+                source = os.path.join(root, filename)
+                out = _xls_out(source, directory, out_dir)
+                if not os.path.exists(out) or os.path.getmtime(out) < os.path.getmtime(source):
+                    filenames.append(source)
+    # Convert the files, in parallel if specified
+    os.makedirs(out_dir, exist_ok=True)
+    convert = partial(_convert_xls, directory=directory, out_dir=out_dir, cache_dir=os.path.join(out_dir, _CACHE_DIR))
+    converted = []
+    for filename, (out, seconds) in zip(filenames, _map_files(convert, filenames, parser, workers)):
+        _progress(tracking, "%s converted in %.2f s", filename, seconds)
+        converted.append(out)
+    return converted
 
 
 
-def MFE_getter(file_list, outfile, MFE_ESI="MFE", combine=False, mz_tol=0.01, R_tol=1.0, parser="1"):
-    """Takes every .csv file whose name is in file_list and creates a new 
-    file out_file containing either the MFE spectra or the ESI spectra 
-    from each file depending on whether MFE_ESI="MFE" or MFE_ESI="ESI". 
-    If combine=True, then all the peaks that are the same between files 
-    (as determined by mz_tol and R_tol) are combined into one list and 
-    other peaks are ignored."""
-    # Set up the information storage system
-    n_files = len(file_list)
-    C12 = [[] for _ in range(n_files)]
-    C12_abundance = [[] for _ in range(n_files)]
-    C13 = [[] for _ in range(n_files)]
-    C13_abundance = [[] for _ in range(n_files)]
-    C132 = [[] for _ in range(n_files)]
-    C132_abundance = [[] for _ in range(n_files)]
-    RT_peak = [[] for _ in range(n_files)]
-    RT_window = [[] for _ in range(n_files)]
-    
-    # Set whether or not the current data is MFE/ESI and should be recorded
-    record = True
+def _get_bindex(values, bins):
+    """Returns an array of the index of the bin that each value falls 
+    into, where the bins are intervals of the form [bins[k], bins[k+1]) 
+    and bins is sorted in increasing order. Values that do not fall 
+    into any bin get an index of -1."""
+    values = np.asarray(values, dtype=float)
+    bins = np.asarray(bins, dtype=float)
+    bindex = np.searchsorted(bins, values, side="right") - 1
+    bindex[(bindex < 0) | (bindex >= len(bins)-1)] = -1
+    return bindex
+
+
+
+class BinCache():
+    """A least-recently-used cache of the raw binned counts made by 
+    MSData.bin_data and LC_MSData.bin_data. Entries are keyed by a hash 
+    of the bin edges along with the other binning arguments except for 
+    the normalization, which is redone on a copy of the cached counts, 
+    so changing only the normalization never re-bins the data. Once the 
+    cached arrays take up more than max_bytes, the least recently used 
+    ones are dropped. Every data object keeps its counts in the one 
+    module-level bin_cache, so max_bytes bounds them all together.
+    
+    Attributes:
+        max_bytes (int): The memory budget of the cache in bytes. 
+            Setting it to 0 turns the cache off.
+        hits (int): The number of lookups that found an entry.
+        misses (int): The number of lookups that did not."""
+    
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+    
+    
+    def get(self, key):
+        """Returns the cached value for key, or None if there is none."""
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+    
+    
+    def put(self, key, value, n_bytes):
+        """Caches value under key, where n_bytes is the memory it takes, 
+        and drops the least recently used entries to stay in budget."""
+        if n_bytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes:
+            old_value, old_bytes = self.entries.popitem(last=False)[1]
+            self.n_bytes -= old_bytes
+    
+    
+    def clear(self):
+        """Drops every entry, for example after the spectra change."""
+        self.entries.clear()
+        self.n_bytes = 0
+    
+    
+    def clear_scope(self, scope):
+        """Drops every entry whose key is a tuple starting with scope."""
+        for key in [key for key in self.entries if key[0] == scope]:
+            self.n_bytes -= self.entries.pop(key)[1]
+
+
+
+# The binned counts of every MSData and LC_MSData object share one memory budget
+bin_cache = BinCache()
+_cache_scopes = count()
+
+
+
+class _ScopedCache():
+    """The entries of a shared BinCache that belong to one data object, 
+    with the same get, put and clear methods as a BinCache. The entries 
+    are dropped from the shared cache when clear is called or when the 
+    data object is deleted."""
+    
+    def __init__(self, cache):
+        self.cache = cache
+        self.scope = next(_cache_scopes)
+        self._finalizer = weakref.finalize(self, cache.clear_scope, self.scope)
+    
+    
+    def get(self, key):
+        return self.cache.get((self.scope, key))
+    
+    
+    def put(self, key, value, n_bytes):
+        self.cache.put((self.scope, key), value, n_bytes)
+    
+    
+    def clear(self):
+        self.cache.clear_scope(self.scope)
+
+
+
+class BinPyramid():
+    """The binned counts of a set of spectra at the finest m/z resolution 
+    of a bin-width sweep, from which the counts for any coarser m/z bins 
+    whose edges are all among the fine edges are found by adding up 
+    adjacent fine bins, without reading the peaks again. The peak count 
+    of each fine bin is kept as well so that method="mean" can be 
+    answered. Only the fine bins that have peaks are stored.
+    
+    Attributes:
+        mz_bins (array): The fine m/z bin edges.
+        key (tuple): The other binning arguments that the counts were 
+            made with. A pyramid is only used for the same arguments.
+        rows (array): The row (spectrum or RT bin) of each stored bin.
+        cols (array): The fine m/z bin of each stored bin.
+        sums (array): The sum of the counts in each stored bin.
+        peak_counts (array): The number of peaks in each stored bin."""
+    
+    def __init__(self, mz_bins, flat_idx, counts, key):
+        self.mz_bins = np.asarray(mz_bins, dtype=float)
+        self.key = key
+        m = len(mz_bins)-1
+        bins, bin_of_peak = np.unique(flat_idx, return_inverse=True)
+        self.rows = bins // m
+        self.cols = bins % m
+        self.sums = np.bincount(bin_of_peak, weights=counts, minlength=len(bins))
+        self.peak_counts = np.bincount(bin_of_peak, minlength=len(bins))
+    
+    
+    def edge_index(self, mz_bins):
+        """Returns the index of each of the given m/z bin edges among the 
+        fine edges, or None if any edge is not a fine edge. Edges that 
+        differ from a fine edge only by rounding error count as equal."""
+        mz_bins = np.asarray(mz_bins, dtype=float)
+        fine = self.mz_bins
+        idx = np.clip(np.searchsorted(fine, mz_bins), 1, len(fine)-1)
+        # Use whichever neighboring fine edge is nearer
+        idx = np.where(mz_bins - fine[idx-1] < fine[idx] - mz_bins, idx-1, idx)
+        if not np.allclose(fine[idx], mz_bins, rtol=1e-9, atol=0) or np.any(np.diff(idx) <= 0):
+            return None
+        return idx
+    
+    
+    def coarsen(self, mz_bins, method):
+        """Returns the flattened (row, m/z bin) index of each of the given 
+        m/z bins that has peaks along with its summed or averaged counts, 
+        or None if the bins are not nested in the fine bins."""
+        edge_idx = self.edge_index(mz_bins)
+        if edge_idx is None:
+            return None
+        m = len(mz_bins)-1
+        # Find the coarse bin of each fine bin, with -1 or m for fine bins outside of the coarse bins
+        col = np.searchsorted(edge_idx, self.cols, side="right") - 1
+        kept = (col >= 0) & (col < m)
+        bins, bin_of_fine = np.unique(self.rows[kept]*m + col[kept], return_inverse=True)
+        values = np.bincount(bin_of_fine, weights=self.sums[kept], minlength=len(bins))
+        if method == "mean":
+            values /= np.bincount(bin_of_fine, weights=self.peak_counts[kept], minlength=len(bins))
+        return bins, values
+
+
+
+def _threshold_levels(sorted_counts, starts, ends, max_counts, thresholds):
+    """Returns, for each peak of sorted_counts, the index of the first of 
+    the sorted thresholds whose cut keeps the peak, or len(thresholds) if 
+    none does. The peaks are in segments sorted by counts, and segment s 
+    holds indices starts[s] to ends[s]-1 and is thresholded against 
+    max_counts[s], so each cut is a binary search. The level of a peak is 
+    the number of cuts at or before it, found with one cumulative sum."""
+    marks = np.zeros(len(sorted_counts)+1, dtype=int)
+    for s in range(len(starts)):
+        cuts = starts[s] + np.searchsorted(sorted_counts[starts[s]:ends[s]], thresholds*max_counts[s], side="right")
+        np.add.at(marks, cuts, 1)
+        # Cancel this segment's cuts for the segments after it
+        marks[ends[s]] -= len(thresholds)
+    return np.cumsum(marks)[:-1]
+
+
+
+def _sweep_counts(flat_idx, counts, levels, n_bins, n_thresholds, method):
+    """Returns an n_thresholds x n_bins array whose row k holds the summed 
+    or averaged counts in each bin of the peaks whose level (as found by 
+    _threshold_levels) is at most k."""
+    kept = levels < n_thresholds
+    idx = levels[kept]*n_bins + flat_idx[kept]
+    binned_counts = np.bincount(idx, weights=counts[kept], minlength=n_thresholds*n_bins).reshape(n_thresholds, n_bins)
+    np.cumsum(binned_counts, axis=0, out=binned_counts)
+    if method == "mean":
+        num_in_bin = np.bincount(idx, minlength=n_thresholds*n_bins).reshape(n_thresholds, n_bins).cumsum(axis=0)
+        np.divide(binned_counts, num_in_bin, out=binned_counts, where=num_in_bin != 0)
+    return binned_counts
+
+
+
+def _bins_key(bins):
+    """Returns a hashable key for an array of bin edges."""
+    bins = np.ascontiguousarray(bins, dtype=float)
+    return (len(bins), hashlib.sha1(bins.tobytes()).hexdigest())
+
+
+
+def _to_float(text):
+    """Returns text as a float, or NaN if it is not a number."""
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+
+def _read_records(filename, parser="1"):
+    """Reads the given .csv file one row at a time and yields a typed 
+    record for each useful row, so that the raw text of the file is 
+    never held in memory all at once. Records are tuples of one of two 
+    forms:
+        ("header", text, RT_window, RT_peak): A compound header, where 
+            text is the raw text of the header, RT_window is a tuple 
+            (RT-start, RT-end) and RT_peak is a float. Either RT value 
+            is None if the header does not give it.
+        ("peak", mz, abundance, MS_mz): An m/z peak belonging to the 
+            last compound header, with all values as floats. MS_mz is 
+            the m/z value as MSData reads it, which is the first column 
+            of a parser "1" row and the same as mz for parser "2". An 
+            m/z value that is not a number is NaN. 
+    The parser argument indicates in which style the data in the file 
+    are organized. Rows of parser "1" whose first column starts with "#" 
+    are headers, and the other rows are peaks if their first column is a 
+    number, such as the point index of an LC-MS export or the m/z value 
+    of an MS export. Any other rows are skipped with a warning. Parser 
+    "2" gives one peak per feature, so each of its rows yields a header 
+    record followed by a peak record."""
+    if parser not in ("1", "2"):
+        raise ValueError("Parser {} is not a recognized parsing method.".format(parser))
+    # Set up regexes to determine retention time windows and peaks
+    RT_window_getter = re.compile(r"rt: (\d+\.\d\d\d)-(\d+\.\d\d\d)")
+    RT_peak_getter = re.compile(r"Cpd \d+: (\d+\.\d\d\d)")
+    with open(filename, "r") as file:
+        csvreader = csv.reader(file)
+        if parser == "1":
+            skipped = 0
+            for row in csvreader:
+                if not row:
+                    continue
+                if row[0][:1] == "#":
+                    RT_window = None
+                    RT_peak = None
+                    window_search = re.search(RT_window_getter, row[0])
+                    if window_search:
+                        RT_window = (float(window_search.group(1)), float(window_search.group(2)))
+                    peak_search = re.search(RT_peak_getter, row[0])
+                    if peak_search:
+                        RT_peak = float(peak_search.group(1))
+                    yield ("header", row[0], RT_window, RT_peak)
+                else:
+                    first = _to_float(row[0])
+                    if np.isnan(first):
+                        skipped += 1
+                        continue
+                    yield ("peak", _to_float(row[1]), float(row[2]), first)
+            if skipped:
+                logger.warning("Skipped %d rows of %s that are neither headers nor start with a number", 
+                               skipped, filename)
+        else:
+            for i, row in enumerate(csvreader):
+                # Skip the headers
+                if i < 3:
+                    continue
+                yield ("header", "", (float(row[50]), float(row[33])), float(row[48]))
+                mz = float(row[28])
+                yield ("peak", mz, float(row[36]), mz)
+
+
+
+class ParsedFile():
+    """The contents of one .csv file, read once into typed arrays from 
+    which MSData, LC_MSData and MFE_getter are all built. 
+
+    Initializes with the name of a datafile in .csv format. The parser 
+    argument indicates in which style the data in the file are organized 
+    so that the data can be properly parsed. Use parse_file to reuse the 
+    contents of files that were already read. 
+
+    Attributes: 
+        parser (str): The parser the file was read with. 
+        headers (list): A length H list of the text of each compound 
+            header, in file order. The headers of parser "2" are blank. 
+        RT_start (array): A length H array of the RT window start of 
+            each header, or NaN if the header does not give it. 
+        RT_end (array): A length H array of the RT window end of each 
+            header, or NaN if the header does not give it. 
+        RT_peak (array): A length H array of the peak RT of each 
+            header, or NaN if the header does not give it. 
+        mz (array): A length P array of the m/z values of every peak, 
+            in file order. 
+        abundance (array): A length P array of the abundance of every 
+            peak. Indices match those of mz. 
+        MS_mz (array): A length P array of the m/z values of every peak 
+            as MSData reads them. Indices match those of mz. 
+        block (array): A length P array of the index of the header that 
+            each peak follows, or -1 for peaks before the first header. 
+        n_bytes (int): The memory taken by the arrays and headers."""
+    
+    
+    def __init__(self, filename, parser="1"):
+        # Grow typed arrays while reading so that memory stays proportional to the parsed values
+        self.parser = parser
+        self.headers = []
+        RT_start = array("d")
+        RT_end = array("d")
+        RT_peak = array("d")
+        mz = array("d")
+        abundance = array("d")
+        MS_mz = array("d")
+        block = array("q")
+        for record in _read_records(filename, parser):
+            if record[0] == "header":
+                self.headers.append(record[1])
+                RT_start.append(np.nan if record[2] is None else record[2][0])
+                RT_end.append(np.nan if record[2] is None else record[2][1])
+                RT_peak.append(np.nan if record[3] is None else record[3])
+            else:
+                mz.append(record[1])
+                abundance.append(record[2])
+                MS_mz.append(record[3])
+                block.append(len(self.headers)-1)
+        self.RT_start = np.asarray(RT_start, dtype=float)
+        self.RT_end = np.asarray(RT_end, dtype=float)
+        self.RT_peak = np.asarray(RT_peak, dtype=float)
+        self.mz = np.asarray(mz, dtype=float)
+        self.abundance = np.asarray(abundance, dtype=float)
+        self.MS_mz = np.asarray(MS_mz, dtype=float)
+        self.block = np.asarray(block, dtype=np.int64)
+        self.n_bytes = (3*len(self.headers) + 4*len(self.mz))*8 + sum(len(text) for text in self.headers)
+    
+    
+    def spectrum(self):
+        """Returns every peak of the file as one dx2 array with rows of 
+        the form [m/z, counts], as MSData reads it."""
+        return np.column_stack([self.MS_mz, self.abundance])
+    
+    
+    def header_values(self, values):
+        """Returns the given length H array of header values for each 
+        peak, carrying the last value given forward over headers that 
+        do not give one. Peaks before any value is given get NaN."""
+        given = np.where(np.isnan(values), -1, np.arange(len(values)))
+        last_given = np.maximum.accumulate(given) if len(given) else given
+        filled = np.append(values, np.nan)[last_given]
+        return np.append(filled, np.nan)[self.block]
+
+
+
+# The files read by parse_file so far, keyed by their path, size, modification time and parser
+parse_cache = BinCache()
+
+
+
+def parse_file(filename, parser="1"):
+    """Returns the ParsedFile of the given .csv file, reusing the one 
+    from an earlier call if the file has not changed since, so that 
+    running several analyses on the same files reads each file only 
+    once per process. Older entries are dropped once parse_cache is 
+    over its max_bytes budget."""
+    if parser not in ("1", "2"):
+        raise ValueError("Parser {} is not a recognized parsing method.".format(parser))
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, parser)
+    parsed = parse_cache.get(key)
+    if parsed is None:
+        parsed = ParsedFile(filename, parser)
+        parse_cache.put(key, parsed, parsed.n_bytes)
+    return parsed
+
+
+
+def _timed(func, *args):
+    """Returns the result of func(*args) along with the number of 
+    seconds the call took. This is a module-level function so that it 
+    can be sent to worker processes."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+
+def _map_files(func, filenames, parser, workers=None):
+    """Yields (func(filename, parser), seconds) for each filename in 
+    filenames, in the same order as filenames. If workers is greater 
+    than 1, the files are parsed in a pool of that many processes; 
+    otherwise they are parsed one after another."""
+    if workers is None or workers <= 1:
+        for filename in filenames:
+            yield _timed(func, filename, parser)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(_timed, repeat(func), filenames, repeat(parser))
+
+
+
+def _read_MS_spectrum(filename, parser="1"):
+    """Reads the .csv file with the given name and returns its MS 
+    spectrum as a dx2 array with rows of the form [m/z, counts]. The 
+    parser argument indicates in which style the data in the file are 
+    organized."""
+    return parse_file(filename, parser).spectrum()
+
+
+
+def _isotope_envelopes(mz, abundance, block, mz_tol, mass_defect=1.003):
+    """Splits a list of peaks into isotope envelopes. Each envelope is 
+    a C12 peak followed by the peaks of its isotopes, where the k-th 
+    isotope peak is within k*(mass_defect +/- mz_tol) of the C12 peak. 
+    The C13 peak must be less abundant than the C12 peak, and every 
+    later isotope peak must be less abundant than the peak before it, 
+    except that the isotopes after the 2 C13 peak only need to be less 
+    abundant than the 2 C13 peak. Envelopes never cross from one block 
+    of peaks to another.
+    
+    The length of the envelope that would start at each peak is found 
+    for all of the peaks at once, one isotope at a time, so only the 
+    walk from one envelope to the next is done peak by peak.
+    
+    Parameters:
+        mz (array): The m/z value of each peak, in file order.
+        abundance (array): The abundance of each peak.
+        block (array): The number of the block that each peak is in.
+        mz_tol (float): The allowed error in the m/z differences.
+        mass_defect (float): The m/z difference between isotopes.
+    
+    Returns:
+        starts (array): The index of the C12 peak of each envelope.
+        lengths (array): The number of peaks in each envelope."""
+    n = len(mz)
+    length = np.ones(n, dtype=int)
+    # The peaks whose envelopes are still growing
+    idx = np.arange(n)
+    k = 1
+    while len(idx) > 0:
+        idx = idx[idx + k < n]
+        diff = mz[idx + k] - mz[idx]
+        # The abundance that the k-th isotope peak must be below
+        ref = abundance[idx + min(k-1, 2)]
+        grows = (block[idx + k] == block[idx]) & (diff <= k*(mass_defect + mz_tol)) & \
+                (diff >= k*(mass_defect - mz_tol)) & (ref > abundance[idx + k])
+        idx = idx[grows]
+        length[idx] += 1
+        k += 1
+    # Walk from each envelope to the next
+    starts = []
+    j = 0
+    while j < n:
+        starts.append(j)
+        j += length[j]
+    starts = np.array(starts, dtype=int)
+    return starts, length[starts]
+
+
+
+def _match_features(C12, RT, C13, same_C12, same_RT, same_C13, mz_tol, R_tol):
+    """Finds the features of a file that are the same as features in 
+    a list of "same" features. Two features are the same if their C12 
+    peaks are within mz_tol, their RT peaks are within R_tol, and their 
+    C13 peaks are either both missing or within mz_tol. Each feature of 
+    the file is matched with the first such feature of the "same" list. 
+    Missing values are NaN, and features with a missing C12 or RT peak 
+    are never matched.
+    
+    The "same" features are sorted by C12 peak so that each feature of 
+    the file only needs to be compared with the ones in a small window 
+    around its C12 peak, and all of the comparisons are done at once.
+    
+    Returns:
+        same_indices (list): The index in the "same" list of the match 
+            for each matched feature of the file.
+        candidate_indices (list): The index of each matched feature of 
+            the file, in increasing order."""
+    # Sort the usable "same" features by C12 peak
+    usable = np.flatnonzero(~np.isnan(same_C12) & ~np.isnan(same_RT))
+    order = usable[np.argsort(same_C12[usable], kind="stable")]
+    sorted_C12 = same_C12[order]
+    # Find the window of "same" features around each feature of the file. The window 
+    # is wider than mz_tol so that rounding cannot leave out a match
+    valid = ~np.isnan(C12) & ~np.isnan(RT)
+    lo = np.searchsorted(sorted_C12, C12 - 2*mz_tol, side="left")
+    hi = np.searchsorted(sorted_C12, C12 + 2*mz_tol, side="right")
+    hi[~valid] = lo[~valid]
+    # List every (feature, "same" feature) pair in the windows
+    window_size = hi - lo
+    pair_candidate = np.repeat(np.arange(len(C12)), window_size)
+    pair_start = np.repeat(lo - (np.cumsum(window_size) - window_size), window_size)
+    pair_same = order[np.arange(len(pair_candidate)) + pair_start]
+    # Check each pair the same way that the features were compared one at a time
+    C13_missing = np.isnan(C13[pair_candidate])
+    same_C13_missing = np.isnan(same_C13[pair_same])
+    match = (np.abs(C12[pair_candidate] - same_C12[pair_same]) <= mz_tol) & \
+            (np.abs(RT[pair_candidate] - same_RT[pair_same]) <= R_tol) & \
+            ((C13_missing & same_C13_missing) | (np.abs(C13[pair_candidate] - same_C13[pair_same]) <= mz_tol))
+    # Keep the first match for each feature of the file
+    first_match = np.full(len(C12), len(same_C12))
+    np.minimum.at(first_match, pair_candidate[match], pair_same[match])
+    candidate_indices = np.flatnonzero(first_match < len(same_C12))
+    return first_match[candidate_indices].tolist(), candidate_indices.tolist()
+
+
+
+def _merge_consensus(table_a, table_b, mz_tol, R_tol):
+    """Combines two tables of features for MFE_getter(align="tree"). Each 
+    table is a tuple (weight, columns), where weight is the number of 
+    files that the table averages and columns is the list of C12 peaks, 
+    C12 abundances, C13 peaks, C13 abundances, 2 C13 peaks, 2 C13 
+    abundances, RT peaks, RT window starts and RT window ends. Only the 
+    features found in both tables are kept, and each value is the mean of 
+    the two weighted by the number of files, so the result is the exact 
+    average over all of the files of both tables."""
+    weight_a, columns_a = table_a
+    weight_b, columns_b = table_b
+    same_indices, candidate_indices = _match_features(columns_b[0], columns_b[6], columns_b[2], 
+                                                      columns_a[0], columns_a[6], columns_a[2], mz_tol, R_tol)
+    weight = weight_a + weight_b
+    columns = [column_a[same_indices]*weight_a/weight + column_b[candidate_indices]*weight_b/weight 
+               for column_a, column_b in zip(columns_a, columns_b)]
+    return weight, columns
+
+
+
+def _tree_align(tables, mz_tol, R_tol, workers=None):
+    """Combines the given tables of features (see _merge_consensus) in 
+    rounds of pairs until one is left, and returns its columns. If 
+    workers is greater than 1, the pairs of each round are combined in 
+    a pool of that many processes."""
+    executor = ProcessPoolExecutor(max_workers=workers) if workers is not None and workers > 1 else None
+    try:
+        while len(tables) > 1:
+            # An odd table out waits for the next round
+            left, right, rest = tables[0:-1:2], tables[1::2], tables[len(tables)//2*2:]
+            args = (left, right, repeat(mz_tol), repeat(R_tol))
+            merged = list(executor.map(_merge_consensus, *args) if executor is not None else map(_merge_consensus, *args))
+            tables = merged + rest
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return tables[0][1]
+
+
+
+def _pad_rows(rows, length):
+    """Returns a len(rows) x length float array whose rows hold the 
+    values of the given lists, padded at the end with NaN."""
+    padded = np.full((len(rows), length), np.nan)
+    for i, row in enumerate(rows):
+        padded[i,:len(row)] = row
+    return padded
+
+
+
+def _blank_nan(values):
+    """Returns the given float array as a list of floats, with the blank 
+    string "" in place of NaN, for writing to a .csv file."""
+    return ["" if np.isnan(value) else value for value in np.asarray(values).tolist()]
+
+
+
+def _MFE_file_features(filename, parser, MFE_ESI="MFE", mz_tol=0.01):
+    """Reads the MFE or ESI features of one file for MFE_getter and returns 
+    the arrays of their C12 peaks, C12 abundances, C13 peaks, C13 
+    abundances, 2 C13 peaks, 2 C13 abundances, RT peaks, RT window starts 
+    and RT window ends, with NaN for missing values. This is a 
+    module-level function so that files can be read in worker processes."""
+    parsed = parse_file(filename, parser)
     
     # Make regexes for identifying rows with MFE/ESI info
     MFE_checker = re.compile(r"MFE")
     ESI_checker = re.compile(r"ESI")
     
-    # Make regexes for getting retention times
-    RT_range_getter = re.compile(r"rt: (\d+\.\d\d\d)-(\d+\.\d\d\d)")
-    RT_peak_getter = re.compile(r"Cpd \d+: (\d+\.\d\d\d)")
+    # Set the m/z difference between isotope peaks
+    mass_defect = 1.003
     
-    # Iterate over each file name and get the relevant information
-    for i, filename in enumerate(file_list):
-        # Read in the file
-        raw_data = np.zeros(1)
-        with open(filename, "r") as file:
-            csvreader = csv.reader(file)
-            raw_data = np.array([row for row in csvreader])
-        # Search for the useable data
-        if parser == "1":
-            # The value j here represents the index of the row we're currently looking through
-            j = 0
-            while j < len(raw_data):
-                ESI_search = re.search(ESI_checker, raw_data[j][0])
-                MFE_search = re.search(MFE_checker, raw_data[j][0])
-                RT_range_search = re.search(RT_range_getter, raw_data[j][0])
-                RT_peak_search = re.search(RT_peak_getter, raw_data[j][0])
-                
-                # Record the current RT values
-                if RT_range_search:
-                    current_RT_range = (float(RT_range_search.group(1)), float(RT_range_search.group(2)))
-                if RT_peak_search:
-                    current_RT_peak = (float(RT_peak_search.group(1)))
-                
-                # Check if we should record the next data based on if it's MFE or ESI
-                if ESI_search and MFE_search:
-                    if MFE_ESI == "MFE":
-                        record = True
-                    elif MFE_ESI == "ESI":
-                        record = False
-                    else:
-                        raise ValueError("MFE_ESI argument must be \"MFE\" or \"ESI\", not \"{}\"".format(str(MFE_ESI)))
-                elif ESI_search and not MFE_search:
-                    if MFE_ESI == "MFE":
-                        record = False
-                    elif MFE_ESI == "ESI":
-                        record = True
-                    else:
-                        raise ValueError("MFE_ESI argument must be \"MFE\" or \"ESI\", not \"{}\"".format(str(MFE_ESI)))
-                
-                # Record the data as appropriate
-                elif raw_data[j][0][0] != "#" and record:
-                    # Add the m/z and abundance values
-                    C12[i].append(float(raw_data[j][1]))
-                    C12_abundance[i].append(float(raw_data[j][2]))
-                    # Add the RT peak as a float and the RT window as a tuple
-                    RT_peak[i].append(current_RT_peak)
-                    RT_window[i].append(current_RT_range)
-                    # Add filler values for C13 and 2 C13 peaks
-                    C13[i].append("")
-                    C13_abundance[i].append("")
-                    C132[i].append("")
-                    C132_abundance[i].append("")
-                    
-                    # Check for isotope traces
-                    mass_defect = 1.003
-                    if j+1 < len(raw_data):
-                        # Check for a C13 peak with m/z difference and abundances
-                        if raw_data[j+1][0][0] != "#":
-                            j1_diff = float(raw_data[j+1][1]) - C12[i][-1]
-                            if j1_diff <= (mass_defect + mz_tol) and j1_diff >= (mass_defect - mz_tol) and C12_abundance[i][-1] > float(raw_data[j+1][2]):
-                                C13[i][-1] = float(raw_data[j+1][1])
-                                C13_abundance[i][-1] = float(raw_data[j+1][2])
-                                # Skip forward a row to avoid considering this peak for status as a C12 peak
-                                j += 1
-                                
-                                # Check for a 2 C13 peak
-                                if j+1 < len(raw_data):
-                                    if raw_data[j+1][0][0] != "#":
-                                        j2_diff = float(raw_data[j+1][1]) - C12[i][-1]
-                                        # Use abundance and m/z difference to determine if this is a 2 C13 peak
-                                        if j2_diff <= 2*(mass_defect + mz_tol) and j2_diff >= 2*(mass_defect - mz_tol) and C13_abundance[i][-1] > float(raw_data[j+1][2]):
-                                            C132[i][-1] = float(raw_data[j+1][1])
-                                            C132_abundance[i][-1] = float(raw_data[j+1][2])
-                                            # Skip forward a row to avoid considering this peak for status as a C12 peak
-                                            j += 1
-                                            
-                                            # Check for further isotopes, but do not record them
-                                            further_consideration = True
-                                            k = 1
-                                            while further_consideration:
-                                                if j+1 < len(raw_data):
-                                                    if raw_data[j+1][0][0] != "#":
-                                                        jn_diff = float(raw_data[j+1][1]) - C12[i][-1]
-                                                        if jn_diff <= (2+k)*(mass_defect + mz_tol) and jn_diff >= (2+k)*(mass_defect - mz_tol) and C132_abundance[i][-1] > float(raw_data[j+1][2]):
-                                                            j += 1
-                                                            k += 1
-                                                        else:
-                                                            further_consideration = False
-                                                    else:
-                                                        further_consideration = False
-                                                else:
-                                                    further_consideration = False
-                
-                # Move on to the next row
-                j += 1
+    # Search for the useable data
+    if parser == "1":
+        # Check which headers are followed by data that should be recorded based on if it's MFE or ESI. 
+        # Headers that are neither keep the setting of the header before them
+        record = True
+        header_record = np.empty(len(parsed.headers), dtype=bool)
+        for i, text in enumerate(parsed.headers):
+            ESI_search = re.search(ESI_checker, text)
+            MFE_search = re.search(MFE_checker, text)
+            if ESI_search and MFE_search:
+                if MFE_ESI == "MFE":
+                    record = True
+                elif MFE_ESI == "ESI":
+                    record = False
+                else:
+                    raise ValueError("MFE_ESI argument must be \"MFE\" or \"ESI\", not \"{}\"".format(str(MFE_ESI)))
+            elif ESI_search and not MFE_search:
+                if MFE_ESI == "MFE":
+                    record = False
+                elif MFE_ESI == "ESI":
+                    record = True
+                else:
+                    raise ValueError("MFE_ESI argument must be \"MFE\" or \"ESI\", not \"{}\"".format(str(MFE_ESI)))
+            header_record[i] = record
         
-        elif parser == "2":
-            # Skip the headers
-            for row in raw_data[3:]:
-                # This format gives only one peak per feature, all nicely organized by row
-                C12[i].append(float(row[28]))
-                C12_abundance[i].append(float(row[36]))
-                RT_peak[i].append(float(row[48]))
-                RT_window[i].append((float(row[50]), float(row[33])))
-                # Add filler values for C13 and 2 C13 peaks
-                C13[i].append("")
-                C13_abundance[i].append("")
-                C132[i].append("")
-                C132_abundance[i].append("")
+        # Gather the recorded peaks along with the number of the block of peaks between headers 
+        # that each one is in, since isotope traces do not continue past a header
+        recorded = parsed.block >= 0
+        recorded[recorded] = header_record[parsed.block[recorded]]
+        peak_mz = parsed.mz[recorded]
+        peak_abundance = parsed.abundance[recorded]
+        peak_block = parsed.block[recorded]
+        # Each peak takes the latest RT values given by the headers before it
+        peak_RT = parsed.header_values(parsed.RT_peak)[recorded]
+        peak_RT_start = parsed.header_values(parsed.RT_start)[recorded]
+        peak_RT_end = parsed.header_values(parsed.RT_end)[recorded]
         
+        # Find the isotope envelopes, whose first peak is the C12 peak
+        starts, lengths = _isotope_envelopes(peak_mz, peak_abundance, peak_block, mz_tol, mass_defect)
+        C12 = peak_mz[starts]
+        C12_abundance = peak_abundance[starts]
+        # Add the RT peak and the start and end of the RT window
+        RT_peak = peak_RT[starts]
+        RT_start = peak_RT_start[starts]
+        RT_end = peak_RT_end[starts]
+        # Add the C13 and 2 C13 peaks, which are missing for short envelopes. Further isotopes are not recorded
+        C13_idx = np.minimum(starts+1, len(peak_mz)-1)
+        C132_idx = np.minimum(starts+2, len(peak_mz)-1)
+        C13 = np.where(lengths >= 2, peak_mz[C13_idx], np.nan)
+        C13_abundance = np.where(lengths >= 2, peak_abundance[C13_idx], np.nan)
+        C132 = np.where(lengths >= 3, peak_mz[C132_idx], np.nan)
+        C132_abundance = np.where(lengths >= 3, peak_abundance[C132_idx], np.nan)
+    
+    elif parser == "2":
+        # This format gives only one peak per feature, all nicely organized by row
+        C12 = parsed.mz
+        C12_abundance = parsed.abundance
+        RT_peak = parsed.RT_peak[parsed.block]
+        RT_start = parsed.RT_start[parsed.block]
+        RT_end = parsed.RT_end[parsed.block]
+        # Add missing values for C13 and 2 C13 peaks
+        C13, C13_abundance, C132, C132_abundance = [np.full(len(C12), np.nan) for _ in range(4)]
+    
+    else:
+        raise ValueError("Parser", parser, "is not a valid parser.")
+    return C12, C12_abundance, C13, C13_abundance, C132, C132_abundance, RT_peak, RT_start, RT_end
+
+
+
+# The columns of the long-format tables written by MFE_getter, after the file and feature columns
+_MFE_COLUMNS = ["C12", "C12_abundance", "C13", "C13_abundance", "C132", "C132_abundance", "RT_peak", 
+                "RT_start", "RT_end"]
+
+
+
+class _MFETableWriter():
+    """Writes the features of one file at a time to a long-format table 
+    in outfile, with one row per feature and the columns file, feature 
+    and those of _MFE_COLUMNS, so that only one file's features need to 
+    be in memory. The output argument is "parquet" or "feather", which 
+    need pyarrow, or "npz", which writes each file's columns as their 
+    own arrays in a .npz file. The file column is categorical over the 
+    given file names. An existing outfile is never overwritten."""
+    
+    def __init__(self, outfile, output, filenames):
+        if output not in ("parquet", "feather", "npz"):
+            raise ValueError("Output {} is not valid. Use \"csv\", \"parquet\", \"feather\", or \"npz\"".format(output))
+        self.output = output
+        # A file listed more than once gets one category
+        self.filenames = list(dict.fromkeys(str(filename) for filename in filenames))
+        self.codes = [self.filenames.index(str(filename)) for filename in filenames]
+        self.n_written = 0
+        if output == "npz":
+            self.file = open(outfile, "xb")
+            self.writer = zipfile.ZipFile(self.file, "w", zipfile.ZIP_STORED, allowZip64=True)
+            self._write_npy("files", np.array(self.filenames, dtype=str))
+            return
+        import pyarrow as pa
+        self.pa = pa
+        # Every chunk shares the same dictionary of file names, which the Feather format requires
+        self.names = pa.array(self.filenames, type=pa.string())
+        fields = [pa.field("file", pa.dictionary(pa.int32(), pa.string())), pa.field("feature", pa.int64())]
+        self.schema = pa.schema(fields + [pa.field(column, pa.float64()) for column in _MFE_COLUMNS])
+        self.file = open(outfile, "xb")
+        if output == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(self.file, self.schema)
         else:
-            raise ValueError("Parser", parser, "is not a valid parser.")
-    # Make every peak list the same length
+            import pyarrow.ipc as ipc
+            self.writer = ipc.new_file(self.file, self.schema)
+    
+    
+    def _write_npy(self, name, values):
+        """Writes the given array to the .npz file under the given name."""
+        with self.writer.open(name + ".npy", "w", force_zip64=True) as member:
+            np.lib.format.write_array(member, np.asarray(values), allow_pickle=False)
+    
+    
+    def append(self, columns):
+        """Writes the given columns of features of the next file, in the 
+        order of _MFE_COLUMNS."""
+        n = len(columns[0])
+        file_idx = self.n_written
+        self.n_written += 1
+        file_column = np.full(n, self.codes[file_idx], dtype=np.int32)
+        feature_column = np.arange(n, dtype=np.int64)
+        if self.output == "npz":
+            for name, values in zip(["file", "feature"] + _MFE_COLUMNS, [file_column, feature_column] + list(columns)):
+                self._write_npy("{}_{:06d}".format(name, file_idx), values)
+        else:
+            pa = self.pa
+            arrays = [pa.DictionaryArray.from_arrays(pa.array(file_column), self.names), pa.array(feature_column)]
+            arrays += [pa.array(np.asarray(values, dtype=float)) for values in columns]
+            self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+    
+    
+    def close(self):
+        """Finishes the table and closes outfile."""
+        self.writer.close()
+        self.file.close()
+
+
+
+def MFE_reader(filename, output=None):
+    """Reads a long-format table written by MFE_getter into a pandas 
+    DataFrame with the columns file, feature, and those of _MFE_COLUMNS, 
+    where file is categorical. The output argument is the format given 
+    to MFE_getter, and is taken from the extension of filename if it is 
+    None."""
+    if output is None:
+        output = os.path.splitext(filename)[1][1:].lower()
+    if output == "parquet":
+        return pd.read_parquet(filename)
+    elif output == "feather":
+        return pd.read_feather(filename)
+    elif output != "npz":
+        raise ValueError("Output {} is not valid. Use \"parquet\", \"feather\", or \"npz\"".format(output))
+    with np.load(filename, allow_pickle=False) as table:
+        filenames = table["files"]
+        # Files that were never written, such as after an error, have no arrays
+        n_files = len([name for name in table.files if name.startswith("feature_")])
+        columns = {name: np.concatenate([table["{}_{:06d}".format(name, i)] for i in range(n_files)]) 
+                   if n_files else np.zeros(0) for name in ["file", "feature"] + _MFE_COLUMNS}
+    columns["file"] = pd.Categorical.from_codes(columns["file"].astype(np.int32), categories=filenames.tolist())
+    return pd.DataFrame(columns)
+
+
+
+@_profiled("MFE_getter")
+def MFE_getter(file_list, outfile, MFE_ESI="MFE", combine=False, mz_tol=0.01, R_tol=1.0, parser="1", 
+               align="sequential", workers=None, output="csv"):
+    """Takes every .csv file whose name is in file_list and creates a new 
+    file out_file containing either the MFE spectra or the ESI spectra 
+    from each file depending on whether MFE_ESI="MFE" or MFE_ESI="ESI". 
+    If combine=True, then all the peaks that are the same between files 
+    (as determined by mz_tol and R_tol) are combined into one list and 
+    other peaks are ignored. Missing values are kept as NaN and written 
+    as blanks.
+    
+    If align="sequential", the files are combined one at a time into a 
+    running average, in the order of file_list. If align="tree", pairs 
+    of files are combined at once and the combined tables are paired up 
+    again, in a balanced tree of about log2(number of files) rounds. Each 
+    table remembers how many files it averages so that every average is 
+    still exact, but the features kept can differ slightly from those of 
+    the sequential order when matches are ambiguous. If workers is 
+    greater than 1, the files are read and each round of pairs is 
+    combined in a pool of that many processes.
+    
+    If output="csv", the features of all of the files are written side 
+    by side in one wide .csv file. If output is "parquet", "feather", or 
+    "npz", the features of each file are instead written to a long-format 
+    table with one row per feature as soon as the file is read, so the 
+    features of only one file are held in memory at a time. Read these 
+    tables with MFE_reader. Parquet and Feather need pyarrow. Combining 
+    files is only written as .csv."""
+    if align != "sequential" and align != "tree":
+        raise ValueError("Alignment {} is not valid. Use \"sequential\" or \"tree\"".format(align))
+    get_features = partial(_MFE_file_features, MFE_ESI=MFE_ESI, mz_tol=mz_tol)
+    if output != "csv":
+        if combine:
+            raise ValueError("Combined features are only written as .csv, not {}".format(output))
+        # Write each file's features as soon as they are read
+        writer = _MFETableWriter(outfile, output, file_list)
+        try:
+            for columns, seconds in _map_files(get_features, file_list, parser, workers):
+                writer.append(columns)
+        finally:
+            writer.close()
+        return
+    # Read the features of each file, in parallel if specified
+    n_files = len(file_list)
+    features = [result for result, seconds in _map_files(get_features, file_list, parser, workers)]
+    C12, C12_abundance, C13, C13_abundance, C132, C132_abundance, RT_peak, RT_start, RT_end = [list(column) for column in zip(*features)]
+    # Make every peak list the same length, with NaN for missing values
     n_peaks = np.max([len(C12[i]) for i in range(n_files)])
-    for i in range(n_files):
-        if len(C12[i]) != n_peaks:
-            for _ in range(n_peaks - len(C12[i])):
-                C12[i].append("")
-                C12_abundance[i].append("")
-                C13[i].append("")
-                C13_abundance[i].append("")
-                C132[i].append("")
-                C132_abundance[i].append("")
-                RT_peak[i].append("")
-                RT_window[i].append(("",""))
+    C12 = _pad_rows(C12, n_peaks)
+    C12_abundance = _pad_rows(C12_abundance, n_peaks)
+    C13 = _pad_rows(C13, n_peaks)
+    C13_abundance = _pad_rows(C13_abundance, n_peaks)
+    C132 = _pad_rows(C132, n_peaks)
+    C132_abundance = _pad_rows(C132_abundance, n_peaks)
+    RT_peak = _pad_rows(RT_peak, n_peaks)
+    RT_start = _pad_rows(RT_start, n_peaks)
+    RT_end = _pad_rows(RT_end, n_peaks)
                 
     # Write the info to a file based on if we're combining peaks or not
     if combine and n_files > 1:
-        # Create a list of peaks that are the same between files, using the first file as a base. 
-        # We check the RT peak, C12 peak, and C13 peak for confirmation
-        same_C12 = C12[0]
-        same_C13 = C13[0]
-        same_RT = RT_peak[0]
-        # We keep track of the 2 C13 peaks and abundances
-        same_C132 = C132[0]
-        same_C132_abundance = C132_abundance[0]
-        # We average together the abundances and RT windows
-        same_C12_abundance = C12_abundance[0]
-        same_C13_abundance = C13_abundance[0]
-        same_RT_window = RT_window[0]
-        # Trim down the list of peaks that are the same between files
-        for file_idx in np.arange(1,n_files):
-            # Keep track of the indices of the features that are the same between files
-            # "same_indices" tracks the indices of values that were previously identified as being the same between files and that match the current file
-            # "candidate_indices" tracks the indices of values in the current file that are identified as being the same as values in previous files
-            same_indices = []
-            candidate_indices = []
-            # Go through each peak of the current file and only keep ones within mz_tol and R_tol of a peak in the "same" list
-            for i in range(n_peaks):
-                candidate_C12 = C12[file_idx][i]
-                candidate_C13 = C13[file_idx][i]
-                candidate_RT = RT_peak[file_idx][i]
-                # Skip blank entries
-                if type(candidate_C12) is str or type(candidate_RT) is str:
-                    continue
-                # Go through each peak of the "same" list for comparison
-                for j in range(len(same_C12)):
-                    if type(same_C12[j]) is str or type(same_RT[j]) is str:
-                        continue
-                    # Compare the C12 peaks
-                    if np.abs(candidate_C12 - same_C12[j]) <= mz_tol:
-                        # Compare the RT peaks
-                        if np.abs(candidate_RT - same_RT[j]) <= R_tol:
-                            # Compare the C13 peaks. They need to either both be blank or both be close to each other
-                            if type(candidate_C13) == str and type(same_C13[j]) == str:
-                                same_indices.append(j)
-                                candidate_indices.append(i)
-                                break
-                            elif type(candidate_C13) == str or type(same_C13[j]) == str:
-                                continue
-                            else:
-                                if np.abs(candidate_C13 - same_C13[j]) <= mz_tol:
-                                    same_indices.append(j)
-                                    candidate_indices.append(i)
-                                    break
-            
-            # Average the current accepted peaks together and throw out the rest. That is, update the old average with the new peaks
-            new_same_C12 = []
-            new_same_C13 = []
-            new_same_RT = []
-            for idx in range(len(same_indices)):
-                new_same_C12.append(same_C12[same_indices[idx]]*file_idx/(file_idx+1) + C12[file_idx][candidate_indices[idx]]/(file_idx+1))
-                if type(same_C13[same_indices[idx]]) == str or type(C13[file_idx][candidate_indices[idx]]) == str:
-                    new_same_C13.append("")
-                else:
-                    new_same_C13.append(same_C13[same_indices[idx]]*file_idx/(file_idx+1) + C13[file_idx][candidate_indices[idx]]/(file_idx+1))
-                new_same_RT.append(same_RT[same_indices[idx]]*file_idx/(file_idx+1) + RT_peak[file_idx][candidate_indices[idx]]/(file_idx+1))
-            same_C12 = new_same_C12
-            same_C13 = new_same_C13
-            same_RT = new_same_RT
-            
-            # Update the 2 C13 peaks, the abundances, and the RT windows
-            new_same_C132 = []
-            new_same_C132_abundance = []
-            new_same_C12_abundance = []
-            new_same_C13_abundance = []
-            new_same_RT_window = []
-            for idx in range(len(same_indices)):
-                # The attributes here are as follows: 
-                # "new_same_" is the list that we're filling with only the values that are the same between the current file and the previously considered files
-                # The list with no prefix is the actual raw data extracted for each file
-                # "same_" is the list that has the values that were the same between the previously considered files but perhaps not this current file 
-                for attribute in [(new_same_C132, C132, same_C132), (new_same_C132_abundance, C132_abundance, same_C132_abundance), 
-                                  (new_same_C12_abundance, C12_abundance, same_C12_abundance), (new_same_C13_abundance, C13_abundance, same_C13_abundance)]:
-                    # If the previously considered lists or the actual raw data have a blank string (str) value, add a blank string value to prevent skewing the average
-                    if type(attribute[2][same_indices[idx]]) == str or type(attribute[1][file_idx][candidate_indices[idx]]) == str:
-                        attribute[0].append("")
-                    # Otherwise, update the average and add it to the "new_same_" list
-                    else:
-                        attribute[0].append(attribute[2][same_indices[idx]]*file_idx/(file_idx+1) + attribute[1][file_idx][candidate_indices[idx]]/(file_idx+1))
-                # Since the format for the RT_window is a little different, we update its values separately
-                if type(same_RT_window[same_indices[idx]][0]) == str or type(RT_window[file_idx][candidate_indices[idx]][0]) == str:
-                    new_same_RT_window.append(("", ""))
-                else:
-                    lower_bound = same_RT_window[same_indices[idx]][0]*file_idx/(file_idx+1) + RT_window[file_idx][candidate_indices[idx]][0]/(file_idx+1)
-                    upper_bound = same_RT_window[same_indices[idx]][1]*file_idx/(file_idx+1) + RT_window[file_idx][candidate_indices[idx]][1]/(file_idx+1)
-                    new_same_RT_window.append((lower_bound, upper_bound))
-            same_C132 = new_same_C132
-            same_C132_abundance = new_same_C132_abundance
-            same_C12_abundance = new_same_C12_abundance
-            same_C13_abundance = new_same_C13_abundance
-            same_RT_window = new_same_RT_window
+        if align == "tree":
+            # Combine pairs of files, then pairs of combined tables, and so on
+            tables = [(1, [C12[i], C12_abundance[i], C13[i], C13_abundance[i], C132[i], C132_abundance[i], 
+                           RT_peak[i], RT_start[i], RT_end[i]]) for i in range(n_files)]
+            (same_C12, same_C12_abundance, same_C13, same_C13_abundance, same_C132, same_C132_abundance, 
+             same_RT, same_RT_start, same_RT_end) = _tree_align(tables, mz_tol, R_tol, workers)
+        else:
+            # Create a list of peaks that are the same between files, using the first file as a base. 
+            # We check the RT peak, C12 peak, and C13 peak for confirmation
+            same_C12 = C12[0]
+            same_C13 = C13[0]
+            same_RT = RT_peak[0]
+            # We keep track of the 2 C13 peaks and abundances
+            same_C132 = C132[0]
+            same_C132_abundance = C132_abundance[0]
+            # We average together the abundances and RT windows
+            same_C12_abundance = C12_abundance[0]
+            same_C13_abundance = C13_abundance[0]
+            same_RT_start = RT_start[0]
+            same_RT_end = RT_end[0]
+            # Trim down the list of peaks that are the same between files
+            for file_idx in np.arange(1,n_files):
+                # Only keep the peaks of the current file that are within mz_tol and R_tol of a peak in the "same" list. 
+                # "same_indices" tracks the indices of values that were previously identified as being the same between files and that match the current file
+                # "candidate_indices" tracks the indices of values in the current file that are identified as being the same as values in previous files
+                same_indices, candidate_indices = _match_features(C12[file_idx], RT_peak[file_idx], C13[file_idx], 
+                                                                  same_C12, same_RT, same_C13, mz_tol, R_tol)
+                
+                # Average the current accepted peaks together and throw out the rest. That is, update the old average with the new peaks. 
+                # A missing value in either the old average or the new peak gives a missing value, which prevents skewing the average
+                same_C12 = same_C12[same_indices]*file_idx/(file_idx+1) + C12[file_idx][candidate_indices]/(file_idx+1)
+                same_C13 = same_C13[same_indices]*file_idx/(file_idx+1) + C13[file_idx][candidate_indices]/(file_idx+1)
+                same_RT = same_RT[same_indices]*file_idx/(file_idx+1) + RT_peak[file_idx][candidate_indices]/(file_idx+1)
+                
+                # Update the 2 C13 peaks, the abundances, and the RT windows the same way
+                same_C132 = same_C132[same_indices]*file_idx/(file_idx+1) + C132[file_idx][candidate_indices]/(file_idx+1)
+                same_C132_abundance = same_C132_abundance[same_indices]*file_idx/(file_idx+1) + C132_abundance[file_idx][candidate_indices]/(file_idx+1)
+                same_C12_abundance = same_C12_abundance[same_indices]*file_idx/(file_idx+1) + C12_abundance[file_idx][candidate_indices]/(file_idx+1)
+                same_C13_abundance = same_C13_abundance[same_indices]*file_idx/(file_idx+1) + C13_abundance[file_idx][candidate_indices]/(file_idx+1)
+                same_RT_start = same_RT_start[same_indices]*file_idx/(file_idx+1) + RT_start[file_idx][candidate_indices]/(file_idx+1)
+                same_RT_end = same_RT_end[same_indices]*file_idx/(file_idx+1) + RT_end[file_idx][candidate_indices]/(file_idx+1)
+        
+        # Sum the abundance values that actually exist
+        total_abundance = np.where(np.isnan(same_C13_abundance), same_C12_abundance, 
+                                   np.where(np.isnan(same_C132_abundance), same_C12_abundance + same_C13_abundance, 
+                                            same_C12_abundance + same_C13_abundance + same_C132_abundance))
         # Write the collected info
         with open(outfile, 'x', newline='') as file:
             csvwriter = csv.writer(file)
@@ -301,30 +1149,10 @@ def MFE_getter(file_list, outfile, MFE_ESI="MFE", combine=False, mz_tol=0.01, R_
             row_to_write += ["Average RT window end"]
             csvwriter.writerow(row_to_write)
             
-            # Write the data
-            for i in range(len(same_C12)):
-                row_to_write = []
-                row_to_write += [same_C12[i]]
-                row_to_write += [same_C12_abundance[i]]
-                row_to_write += [same_C13[i]]
-                row_to_write += [same_C13_abundance[i]]
-                row_to_write += [same_C132[i]]
-                row_to_write += [same_C132_abundance[i]]
-                # Sum the abundance values that actually exist; the ones that don't exist should be the empty string ""
-                if type(same_C12_abundance[i]) != str:
-                    if type(same_C13_abundance[i]) != str:
-                        if type(same_C132_abundance[i]) != str:
-                            row_to_write += [same_C12_abundance[i] + same_C13_abundance[i] + same_C132_abundance[i]]
-                        else:
-                            row_to_write += [same_C12_abundance[i] + same_C13_abundance[i]]
-                    else:
-                        row_to_write += [same_C12_abundance[i]]
-                else:
-                    row_to_write += [""]
-                row_to_write += [same_RT[i]]
-                row_to_write += [same_RT_window[i][0]]
-                row_to_write += [same_RT_window[i][1]]
-                csvwriter.writerow(row_to_write)
+            # Write the data, with blanks for missing values
+            columns = [same_C12, same_C12_abundance, same_C13, same_C13_abundance, same_C132, 
+                       same_C132_abundance, total_abundance, same_RT, same_RT_start, same_RT_end]
+            csvwriter.writerows(zip(*[_blank_nan(column) for column in columns]))
     
     else:
         with open(outfile, 'x', newline='') as file:
@@ -345,27 +1173,118 @@ def MFE_getter(file_list, outfile, MFE_ESI="MFE", combine=False, mz_tol=0.01, R_
                 row_to_write += [""]
             csvwriter.writerow(row_to_write)
             
-            # Write the data
-            for i in range(n_peaks):
-                row_to_write = []
-                for j in range(n_files):
-                    row_to_write += [C12[j][i]]
-                    row_to_write += [C12_abundance[j][i]]
-                    row_to_write += [C13[j][i]]
-                    row_to_write += [C13_abundance[j][i]]
-                    row_to_write += [C132[j][i]]
-                    row_to_write += [C132_abundance[j][i]]
-                    row_to_write += [RT_peak[j][i]]
-                    row_to_write += [RT_window[j][i][0]]
-                    row_to_write += [RT_window[j][i][1]]
-                    row_to_write += [""]
-                csvwriter.writerow(row_to_write)
-
-
-
-def MFE_PCA(filename, samples, d, digits=3, get_V=False):
+            # Write the data, with blanks for missing values and a blank column between files
+            columns = []
+            for j in range(n_files):
+                columns += [_blank_nan(C12[j]), _blank_nan(C12_abundance[j]), _blank_nan(C13[j]), 
+                            _blank_nan(C13_abundance[j]), _blank_nan(C132[j]), _blank_nan(C132_abundance[j]), 
+                            _blank_nan(RT_peak[j]), _blank_nan(RT_start[j]), _blank_nan(RT_end[j]), [""]*n_peaks]
+            csvwriter.writerows(zip(*columns))
+
+
+
+class _CenteredOperator(spla.LinearOperator):
+    """The matrix X - 1*means^T as a LinearOperator, where means holds 
+    the column means of X, so that a sparse X can be mean-centered for 
+    an SVD without ever making the dense centered matrix."""
+    
+    def __init__(self, X):
+        self.X = X
+        self.means = np.asarray(X.mean(axis=0)).ravel()
+        super().__init__(dtype=float, shape=X.shape)
+    
+    
+    def _matvec(self, x):
+        x = np.ravel(x)
+        return self.X @ x - self.means.dot(x)
+    
+    
+    def _matmat(self, x):
+        return self.X @ x - np.outer(np.ones(self.shape[0]), self.means @ x)
+    
+    
+    def _rmatvec(self, y):
+        y = np.ravel(y)
+        return self.X.T @ y - self.means*np.sum(y)
+    
+    
+    def _rmatmat(self, y):
+        return self.X.T @ y - np.outer(self.means, np.sum(y, axis=0))
+
+
+
+def _chunks(n, chunk_size, min_size=1):
+    """Returns a list of (start, end) ranges of at most chunk_size rows 
+    that cover rows 0 to n-1. A last range with fewer than min_size rows 
+    is merged into the range before it."""
+    chunk_size = max(chunk_size, min_size)
+    bounds = list(range(0, n, chunk_size)) + [n]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_size:
+        del bounds[-2]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+
+def _randomized_axes(A, k, n_oversamples=10, n_iter=4, random_state=None):
+    """Returns the first k right singular vectors of the matrix or 
+    LinearOperator A as the rows of a kxn array, using the randomized 
+    SVD of Halko, Martinsson and Tropp. The range of A is sampled with 
+    k + n_oversamples random vectors, refined with n_iter power 
+    iterations, and the small projected matrix is decomposed exactly."""
+    rng = np.random.default_rng(random_state)
+    l = min(k + n_oversamples, min(A.shape))
+    Q, _ = la.qr(A @ rng.standard_normal((A.shape[1], l)), mode="economic")
+    for _ in range(n_iter):
+        Q, _ = la.qr(A.T @ Q, mode="economic")
+        Q, _ = la.qr(A @ Q, mode="economic")
+    B = (A.T @ Q).T
+    U, S, Vt = la.svd(B, full_matrices=False)
+    return Vt[:k]
+
+
+
+def _principal_axes(X, d, backend="exact", n_oversamples=10, n_iter=4, chunk_size=100, random_state=None):
+    """Finds the principal axes of the rows of X, which may be an array 
+    or a scipy.sparse matrix. Returns the mean of the rows and an array 
+    Vt whose rows are at least the first d principal axes, in order of 
+    decreasing singular value.
+    
+    Parameters:
+        backend (str): If "exact", the top d singular vectors of the 
+            implicitly centered X are found by ARPACK, or by a thin SVD 
+            when X is too small for ARPACK to find d of them. If 
+            "randomized", a randomized SVD with the given n_oversamples, 
+            n_iter and random_state is used. If "incremental", an 
+            IncrementalPCA is fit to chunk_size rows at a time."""
+    if backend == "exact":
+        centered = _CenteredOperator(X)
+        # ARPACK can only find fewer singular vectors than the smaller dimension of X
+        if d < min(X.shape):
+            U, S, Vt = spla.svds(centered, k=d, random_state=random_state)
+            order = np.argsort(S)[::-1]
+            return centered.means, Vt[order]
+        dense = X.toarray() if sp.issparse(X) else np.asarray(X)
+        U, S, Vt = la.svd(dense - centered.means, full_matrices=False)
+        return centered.means, Vt[:d]
+    elif backend == "randomized":
+        centered = _CenteredOperator(X)
+        return centered.means, _randomized_axes(centered, d, n_oversamples, n_iter, random_state)
+    elif backend == "incremental":
+        ipca = IncrementalPCA(n_components=d)
+        for start, end in _chunks(X.shape[0], chunk_size, d):
+            chunk = X[start:end]
+            ipca.partial_fit(chunk.toarray() if sp.issparse(chunk) else chunk)
+        return ipca.mean_, ipca.components_
+    else:
+        raise ValueError("Backend {} is not a valid PCA backend.".format(backend))
+
+
+
+@_profiled("MFE_PCA")
+def MFE_PCA(filename, samples, d, digits=3, get_V=False, backend="exact", n_oversamples=10, n_iter=4, 
+            chunk_size=100, random_state=None):
     """Given a file of C12 peaks and abundances (generated from 
-    MFE_getter and then trimmed by hand), creates a list of all given 
+    MFE_getter, and possibly trimmed by hand), creates a list of all given 
     features, creates a matrix of the abundances of each feature in 
     each list/column, and then performs PCA on it. Since missing 
     features are more a result of poor machine sensitivity and not 
@@ -376,13 +1295,20 @@ def MFE_PCA(filename, samples, d, digits=3, get_V=False):
     Parameters:
         filename (str): A .csv file with columns of the form "m/z, 
             abundance, blank, m/z, abundance, blank, m/z, ..." etc., 
-            for each sample.
+            for each sample, or the uncombined output of MFE_getter. 
+            Blank m/z cells are skipped.
         samples (int): The number of samples in the file.
         d (int): The number of principal components to look at.
         digits (int): The number of digits of accuracy to use after 
             the decimal place for determining if features are unique.
         get_V (bool): Whether or not to also return the projection 
             matrix Vt.
+        backend (str): The SVD used for PCA. "exact" uses the full 
+            SVD. "randomized" uses a randomized SVD with n_oversamples 
+            extra samples of the range, n_iter power iterations, and 
+            the seed random_state. "incremental" fits the samples 
+            chunk_size at a time with an IncrementalPCA. The last two 
+            only find the first d rows of Vt.
     
     Returns:
         projected_data (n-darray): An array of the samples projected 
@@ -392,67 +1318,38 @@ def MFE_PCA(filename, samples, d, digits=3, get_V=False):
             the data matrix.
         Vt (n-darray): The projection matrix Vt."""
     
-    # Get the data
-    with open(filename, "r") as file:
-        csvreader = csv.reader(file)
-        raw_data = np.array([row for row in csvreader])
-        # Skip the header
-        raw_data = raw_data[1:,:]
+    # Get the data as floats, with NaN for blanks
+    raw_data = pd.read_csv(filename, header=0, skip_blank_lines=False)
+    # Files straight from MFE_getter have 10 columns for each sample, with the C13 peak after the 
+    # C12 abundance. Hand-trimmed ones have 3, and may keep the C12 header of MFE_getter
+    headers = [str(column) for column in raw_data.columns]
+    stride = 10 if len(headers) > 2 and headers[2].startswith("C13 Peak (m/z)") else 3
     
     # Assert that their are at least "samples" number of samples here
-    raw_num = (raw_data.shape[1] + 1)/3
+    raw_num = (raw_data.shape[1] + 1)//stride
     assert raw_num >= samples, "Only {} samples in file!".format(raw_num)
     
-    # Get all of the m/z features
-    feature_set = set()
-    # Iterate over each sample
-    for i in range(samples):
-        idx = i*3
-        # Iterate over each feature until we reach a blank feature
-        j = 0
-        while raw_data[j, idx] != "" and j + 1 < raw_data.shape[0]:
-            feature_set.add(np.round(float(raw_data[j, idx]), digits))
-            j += 1
-    
-    # Make a dictionary mapping features to indices
-    n = len(feature_set)
-    feature_dict = {feat:i for i,feat in enumerate(feature_set)}
+    # Gather the m/z and abundance of every feature of every sample, one sample per row
+    mz = raw_data.iloc[:, 0:samples*stride:stride].to_numpy(dtype=float).T
+    abundance = raw_data.iloc[:, 1:samples*stride:stride].to_numpy(dtype=float).T
+    present = ~np.isnan(mz)
+    sample_idx = np.nonzero(present)[0]
+    
+    # Index the unique rounded features
+    features, feature_idx = np.unique(np.round(mz[present], digits), return_inverse=True)
+    n = len(features)
+    idx_dict = dict(enumerate(features))
     
     # Make a data matrix
     data = np.zeros((samples, n))
-    # Iterate over each sample
-    for i in range(samples):
-        idx = i*3
-        # Iterate over each feature until we reach a blank feature
-        j = 0
-        while raw_data[j, idx] != "" and j + 1 < raw_data.shape[0]:
-            # Get the index for the feature in the data matrix
-            raw_mz = float(raw_data[j, idx])
-            feature_idx = feature_dict[np.round(raw_mz, digits)]
-            # Fill in the matrix
-            data[i, feature_idx] = float(raw_data[j, idx+1])
-            j += 1
-        # Get the minimum non-zero value
-        zero_mask = data[i,:] == 0
-        non_zero_data = data[i,:].copy()
-        non_zero_data[zero_mask] = np.inf
-        min_val = np.min(non_zero_data)
-        # Fill in zeros with half of the minimum for the sample
-        for k in range(n):
-            if data[i,k] == 0:
-                data[i,k] = min_val/2
-        
-    
-    # Make a dictionary that's the reverse of the feature dictionary
-    dict_features = list(feature_dict.keys())
-    dict_indices = list(feature_dict.values())
-    idx_dict = {dict_indices[i]:dict_features[i] for i in range(n)}
+    data[sample_idx, feature_idx] = abundance[present]
+    # Fill in zeros with half of the minimum non-zero value for each sample
+    zero_mask = data == 0
+    min_vals = np.min(np.where(zero_mask, np.inf, data), axis=1)
+    data = np.where(zero_mask, min_vals[:,None]/2, data)
     
     # Do PCA on the centered data
-    means = np.mean(data, axis=0)
-    data_centered = data - means
-    # Get the svd of the data
-    U, S, Vt = la.svd(data_centered)
+    means, Vt = _principal_axes(data, d, backend, n_oversamples, n_iter, chunk_size, random_state)
     # Project onto the principal component space
     projected_data = data.dot(Vt.T[:,:d])
     
@@ -469,7 +1366,10 @@ class MSData():
     
     Initializes with the path of a directory from which to draw spectra 
     in csv format. The parser argument indicates in which style the data 
-    in the files are organized so that the data can be properly parsed.
+    in the files are organized so that the data can be properly parsed. 
+    If workers is greater than 1, the files are parsed in a pool of that 
+    many processes. If tracking is True, the time taken to parse each 
+    file is logged.
     
     Attributes:
         N (int): The number of spectra.
@@ -486,11 +1386,24 @@ class MSData():
         spectra (list): A length N list of arrays corresponding to the 
             spectrum attributes of the data attribute. Indices match those 
             of data.
+        bin_cache (_ScopedCache): This object's part of the module-level 
+            bin_cache of binned counts used by bin_data. Call 
+            bin_cache.clear() after changing the spectra.
+        pyramid (BinPyramid, None): The fine binned counts made by 
+            build_pyramid, if any.
+        intensity_order (array, None): The permutation that sorts the 
+            peaks of each spectrum by counts, made by bin_data_sweep. 
+            Set it to None after changing the spectra.
     
     Functions:
         bin_data(mz_bins, RT_bins, method): Returns an array of the 
             MS counts for each bin. The method parameter determines 
             if the counts are summed or averaged.
+        bin_data_sweep(mz_bins, thresholds, method): Returns the 
+            binned counts for each of several thresholds at once.
+        build_pyramid(mz_bins, thresh): Bins the data once at a fine 
+            resolution so that bin_data can answer coarser nested bins 
+            without reading the peaks again.
         plot_bins(mz_bins, RT_bins, N_labels, method): Plots a graph 
             of the binned data.
         PCA(d): Project the binned spectra into a d-dimensional space 
@@ -501,8 +1414,11 @@ class MSData():
         """
     
     
-    def __init__(self, path="C:\\Research\Data", parser="1"):
+    def __init__(self, path="C:\\Research\Data", parser="1", workers=None, tracking=False):
         # Initialize counters and data storage
+        self.bin_cache = _ScopedCache(bin_cache)
+        self.pyramid = None
+        self.intensity_order = None
         self.N = 0
         self.data = []
         self.sex = []
@@ -516,100 +1432,68 @@ class MSData():
         elif parser == "2":
             sex_finder = re.compile(r"\d*[_ ]+(M|F)\d* ")
             cdr_finder = re.compile(r"\d*[_ ]+\w([0-4]{1,2}) ")
+        else:
+            raise ValueError("Parser", parser, "is not a valid parser")
         
         # Get the path from which the files are to be taken
         directory = os.path.abspath(path)
         
-        # Get and parse all of the files
+        # Get the names of all of the files in a fixed order
+        filenames = []
+        filepaths = []
         for root, dirs, files in os.walk(directory):
-            for filename in files:
-                
-                # Parse according to the specified method
-                if parser == "1":
-                    if filename.endswith(".csv"):
-                        with open(path+"/"+filename, "r") as file:
-                            self.N += 1
-                            csvreader = csv.reader(file)
-                            raw_data = np.array([row for row in csvreader])
-                        # Set each data entry with the right default values
-                        n = len(raw_data)-1
-                        data_list = ["O", -1, np.zeros((n,2))]
-                        # Look for sample sex
-                        sex_search = re.search(sex_finder, filename)
-                        if sex_search:
-                            if sex_search.group(1) == "F":
-                                data_list[0] = "F"
-                            elif sex_search.group(1) == "B":
-                                data_list[0] = "M"
-                        # Look for sample CDR
-                        cdr_search = re.search(cdr_finder, filename)
-                        if cdr_search:
-                            data_list[1] = int(cdr_search.group(1))
-                        # Fill in the m/z values and counts
-                        i = 0
-                        j = 0
-                        while j < n:
-                            # Skip headers
-                            if raw_data[i][0].replace(".","",1).isdigit():
-                                data_list[2][j,0] = float(raw_data[i][0])
-                                data_list[2][j,1] = float(raw_data[i][2])
-                                j += 1
-                            else:
-                                pass
-                            i += 1
-                        # Add the data list to the data holders
-                        self.data.append(data_list)
-                        self.sex.append(data_list[0])
-                        self.cdr.append(data_list[1])
-                        self.spectra.append(data_list[2])
-                
-                elif parser == "2":
-                    if filename.endswith(".csv"):
-                        with open(path+"\\"+filename, "r") as file:
-                            self.N += 1
-                            csvreader = csv.reader(file)
-                            raw_data = np.array([row for row in csvreader])
-                        # Set each data entry with the right default values
-                        n = len(raw_data)-3
-                        data_list = ["O", -1, np.zeros((n,2))]
-                        # Look for sample sex
-                        sex_search = re.search(sex_finder, filename)
-                        if sex_search:
-                            data_list[0] = sex_search.group(1)
-                        # Look for sample CDR
-                        cdr_search = re.search(cdr_finder, filename)
-                        if cdr_search:
-                            # Check for non-integer CDR values
-                            cdr_str = cdr_search.group(1)
-                            if len(cdr_str) == 1:
-                                data_list[1] = int(cdr_search.group(1))
-                            elif len(cdr_str) > 1:
-                                first_digit = int(cdr_str[0])
-                                second_digit = int(cdr_str[2])
-                                data_list[1] = first_digit + 0.1*second_digit
-                        # Fill in the m/z values and counts
-                        for i in range(n):
-                            data_list[2][i,0] = float(raw_data[i+3][28])
-                            data_list[2][i,1] = float(raw_data[i+3][36]) #51 is vol
-                        # Add the data list to the data holders
-                        self.data.append(data_list)
-                        self.sex.append(data_list[0])
-                        self.cdr.append(data_list[1])
-                        self.spectra.append(data_list[2])
-                            
-                else:
-                    raise ValueError("Parser", parser, "is not a valid parser")
+            for filename in sorted(files):
+                if filename.endswith(".csv"):
+                    filenames.append(filename)
+                    filepaths.append(os.path.join(root, filename))
+        
+        # Parse all of the files, in parallel if specified
+        spectra = _map_files(_read_MS_spectrum, filepaths, parser, workers)
+        for filename, (spectrum, seconds) in zip(filenames, spectra):
+            _progress(tracking, "%s parsed in %.2f s", filename, seconds)
+            self.N += 1
+            # Set each data entry with the right default values
+            data_list = ["O", -1, spectrum]
+            # Look for sample sex
+            sex_search = re.search(sex_finder, filename)
+            if sex_search:
+                if parser == "2":
+                    data_list[0] = sex_search.group(1)
+                elif sex_search.group(1) == "F":
+                    data_list[0] = "F"
+                elif sex_search.group(1) == "B":
+                    data_list[0] = "M"
+            # Look for sample CDR
+            cdr_search = re.search(cdr_finder, filename)
+            if cdr_search:
+                # Check for non-integer CDR values
+                cdr_str = cdr_search.group(1)
+                if len(cdr_str) == 1:
+                    data_list[1] = int(cdr_search.group(1))
+                elif len(cdr_str) > 1:
+                    first_digit = int(cdr_str[0])
+                    second_digit = int(cdr_str[2])
+                    data_list[1] = first_digit + 0.1*second_digit
+            # Add the data list to the data holders
+            self.data.append(data_list)
+            self.sex.append(data_list[0])
+            self.cdr.append(data_list[1])
+            self.spectra.append(data_list[2])
         self.sex = np.array(self.sex)
         self.cdr = np.array(self.cdr)
     
     
+    @_profiled("MSData.bin_data")
     def bin_data(self, mz_bins, thresh=1.0, method="sum", normalize=None, 
-                 tracking=False):
+                 tracking=False, engine="numpy"):
         """Returns an array of the MS counts for each bin. The method 
         parameter determines if the counts are summed or averaged. If 
         a spectrum has a value that does not fall into any bin, that 
         value is discarded. Optionally, takes bins above a certain 
-        threshold for count numbers and sets them to zero.
+        threshold for count numbers and sets them to zero. The counts 
+        are cached in bin_cache before normalization, so calling this 
+        again with the same bins, thresh, method and engine only redoes 
+        the normalization.
         
         Parameters: 
             mz_bins (list): The m/z values that delimit the m/z bins. 
@@ -629,12 +1513,182 @@ class MSData():
             tracking (bool): Whether or not to print checkpoints. 
                 Checkpoints include, but are not limited to, when a 
                 value is discarded.
+            engine (str): If "numpy", all of the spectra are binned 
+                at once with array operations. If "loop", each peak is 
+                binned one at a time. The "loop" engine is much slower 
+                and is kept as a reference for checking the output of 
+                the "numpy" engine.
         
         Returns:
             binned_counts (nd-array): An Nxm array of the MS counts for 
                 each bin, where N is the number of spectra and m is the 
                 number of bins."""
-        # Determine the counts for each bin in each spectrum
+        if method != "sum" and method != "mean":
+            raise ValueError(method + "is not a valid method.")
+        # Determine the counts for each bin in each spectrum, unless they are already cached
+        key = (_bins_key(mz_bins), thresh, method, engine)
+        binned_counts = self.bin_cache.get(key)
+        if _profiler is not None:
+            _profiler.count(cache_hits=binned_counts is not None)
+        if binned_counts is None:
+            # Use the pyramid if the bins are nested in its fine bins
+            coarse = None
+            if engine == "numpy" and self.pyramid is not None and self.pyramid.key == (thresh,):
+                coarse = self.pyramid.coarsen(mz_bins, method)
+            if coarse is not None:
+                binned_counts = np.zeros(self.N*(len(mz_bins)-1))
+                binned_counts[coarse[0]] = coarse[1]
+                binned_counts = binned_counts.reshape(self.N, len(mz_bins)-1)
+            elif engine == "numpy":
+                binned_counts = self._bin_numpy(mz_bins, thresh, method, tracking)
+            elif engine == "loop":
+                binned_counts = self._bin_loop(mz_bins, thresh, method, tracking)
+            else:
+                raise ValueError("Engine {} is not a valid binning engine.".format(engine))
+            self.bin_cache.put(key, binned_counts, binned_counts.nbytes)
+        # Copy the counts so that the cached counts are never changed
+        return self._normalize(binned_counts.copy(), normalize)
+    
+    
+    def _normalize(self, binned_counts, normalize):
+        """Normalizes the given Nxm array of binned counts in place and 
+        returns it. See bin_data for the normalization methods."""
+        if normalize is None:
+            pass
+        elif normalize == "scale_ind":
+            binned_counts /= np.max(binned_counts, axis=1, keepdims=True)
+        elif normalize == "scale_all":
+            binned_counts /= np.max(binned_counts)
+        elif normalize == "norm":
+            binned_counts /= np.array([la.norm(binned_counts, axis=1)]).T
+        else:
+            raise ValueError("Input", normalize, "is not a valid normalization method.")
+        return binned_counts
+    
+    
+    @_profiled("MSData.bin_data_sweep")
+    def bin_data_sweep(self, mz_bins, thresholds, method="sum", normalize=None, tracking=False):
+        """Returns bin_data(mz_bins, thresh, method, normalize) for each 
+        threshold in thresholds, stacked into a TxNxm array. The peaks 
+        are binned once: each peak is given the first threshold that 
+        keeps it by cutting the intensity-sorted peaks of its spectrum 
+        (see intensity_order), and the counts for every threshold are 
+        then running sums over the thresholds. The raw counts for each 
+        threshold are also put in bin_cache, so later bin_data calls 
+        with these thresholds are free."""
+        if method != "sum" and method != "mean":
+            raise ValueError(method + "is not a valid method.")
+        thresholds = np.asarray(thresholds, dtype=float)
+        sort = np.argsort(thresholds)
+        m = len(mz_bins)-1
+        spectrum_idx, mz_vals, counts = self._flat_peaks()
+        
+        # Cut each spectrum's sorted peaks at each threshold, relative to that spectrum's maximum
+        _progress(tracking, "Sorting peaks by intensity")
+        order = self._intensity_order()
+        sorted_counts = counts[order]
+        num_peaks = np.bincount(spectrum_idx, minlength=self.N)
+        ends = np.cumsum(num_peaks)
+        max_counts = np.zeros(self.N)
+        max_counts[num_peaks > 0] = sorted_counts[ends[num_peaks > 0]-1]
+        levels = np.empty(len(counts), dtype=int)
+        levels[order] = _threshold_levels(sorted_counts, ends - num_peaks, ends, max_counts, thresholds[sort])
+        
+        # Bin the peaks once and add them up over the thresholds
+        _progress(tracking, "Working on m/z bins")
+        bindex = _get_bindex(mz_vals, mz_bins)
+        in_bin = bindex != -1
+        sweep = _sweep_counts(spectrum_idx[in_bin]*m + bindex[in_bin], counts[in_bin], levels[in_bin], 
+                              self.N*m, len(thresholds), method)
+        binned_counts = np.empty((len(thresholds), self.N, m))
+        for k, i in enumerate(sort):
+            raw_counts = sweep[k].reshape(self.N, m)
+            self.bin_cache.put((_bins_key(mz_bins), thresholds[i], method, "numpy"), raw_counts, raw_counts.nbytes)
+            binned_counts[i] = self._normalize(raw_counts.copy(), normalize)
+        return binned_counts
+    
+    
+    def build_pyramid(self, mz_bins, thresh=1.0, tracking=False):
+        """Bins the data once with the fine m/z bins mz_bins. After this, 
+        bin_data answers any request with the same thresh and engine 
+        "numpy" whose m/z bin edges are all among these edges by adding 
+        up the fine bins, without reading the peaks again. This makes 
+        sweeps over bin widths much faster."""
+        flat_idx, counts = self._bin_indices(mz_bins, thresh, tracking)
+        self.pyramid = BinPyramid(mz_bins, flat_idx, counts, (thresh,))
+    
+    
+    def _flat_peaks(self):
+        """Stacks all of the spectra into one long list of peaks and 
+        returns three flat arrays: the index of the spectrum each peak 
+        belongs to, the m/z value of each peak, and the counts of each 
+        peak."""
+        num_peaks = np.array([len(spectrum) for spectrum in self.spectra], dtype=int)
+        spectrum_idx = np.repeat(np.arange(self.N), num_peaks)
+        peaks = np.concatenate([np.asarray(spectrum, dtype=float).reshape(-1,2) for spectrum in self.spectra])
+        return spectrum_idx, peaks[:,0], peaks[:,1]
+    
+    
+    def _intensity_order(self):
+        """Returns the permutation of the flat peaks that sorts them by 
+        spectrum and then by counts, computing it the first time."""
+        if self.intensity_order is None:
+            spectrum_idx, mz_vals, counts = self._flat_peaks()
+            self.intensity_order = np.lexsort((counts, spectrum_idx))
+        return self.intensity_order
+    
+    
+    def _bin_indices(self, mz_bins, thresh, tracking):
+        """Stacks all of the spectra into flat arrays of spectrum indices, 
+        m/z values, and counts, and finds the bin of each m/z value by 
+        binary search. Returns the flattened (spectrum, bin) index and 
+        the counts of each peak that falls into a bin and meets the 
+        threshold criteria."""
+        m = len(mz_bins)-1
+        mz_bins = np.asarray(mz_bins, dtype=float)
+        spectrum_idx, mz_vals, counts = self._flat_peaks()
+        num_peaks = np.bincount(spectrum_idx, minlength=self.N)
+        # Skip values above the threshold for their spectrum
+        max_counts = np.maximum.reduceat(counts, np.cumsum(num_peaks) - num_peaks)
+        kept = counts <= thresh*max_counts[spectrum_idx]
+        # Find the bin of each m/z value, with -1 for values not in a bin
+        bindex = _get_bindex(mz_vals, mz_bins)
+        discarded = kept & (bindex == -1)
+        if tracking and logger.isEnabledFor(logging.DEBUG):
+            positions = np.arange(len(mz_vals)) - np.repeat(np.cumsum(num_peaks) - num_peaks, num_peaks)
+            for j in np.flatnonzero(discarded):
+                logger.debug("M/Z value at position %d of spectrum at index %d discarded for not being in a bin.", 
+                             positions[j], spectrum_idx[j])
+        if tracking or _profiler is not None:
+            n_discarded = np.count_nonzero(discarded)
+            _progress(tracking, "%d of %d peaks discarded for not being in a bin.", n_discarded, len(counts))
+            if _profiler is not None:
+                n_binned = np.count_nonzero(kept) - n_discarded
+                _profiler.count(peaks_read=len(counts), peaks_above_thresh=len(counts) - np.count_nonzero(kept), 
+                                peaks_outside_bins=n_discarded, peaks_binned=n_binned)
+        kept &= bindex != -1
+        return spectrum_idx[kept]*m + bindex[kept], counts[kept]
+    
+    
+    def _bin_numpy(self, mz_bins, thresh, method, tracking):
+        """Bins every peak of every spectrum at once. The bin of each 
+        m/z value is found by binary search, and the counts are added 
+        up per (spectrum, bin) pair."""
+        m = len(mz_bins)-1
+        flat_idx, counts = self._bin_indices(mz_bins, thresh, tracking)
+        # Add up the counts in each bin of each spectrum
+        binned_counts = np.bincount(flat_idx, weights=counts, minlength=self.N*m).reshape(self.N, m)
+        # If method is by means, divide by peak count per bin
+        if method == "mean":
+            peak_count = np.bincount(flat_idx, minlength=self.N*m).reshape(self.N, m)
+            np.divide(binned_counts, peak_count, out=binned_counts, where=peak_count != 0)
+        return binned_counts
+    
+    
+    def _bin_loop(self, mz_bins, thresh, method, tracking):
+        """Bins each peak of each spectrum one at a time by checking 
+        every bin. This is slow, but is kept as a reference for the 
+        output of _bin_numpy."""
         binned_counts = np.zeros((self.N, len(mz_bins)-1))
         for i in range(self.N):
             num_peaks = len(self.spectra[i])
@@ -651,38 +1705,20 @@ class MSData():
                 mz_val = self.spectra[i][j][0]
                 for k in range(len(mz_bins)-1):
                     if mz_val >= mz_bins[k] and mz_val < mz_bins[k+1]:
-                        binned_counts[i,k] += self.spectra[i][j][1]
                         included = True
                         # Determine counts for each bin
                         if method == "mean":
                             peak_count[k] += 1
-                            binned_counts[i,k] += self.spectra[i][j][1]
-                        elif method == "sum":
-                            binned_counts[i,k] += self.spectra[i][j][1]
-                        else:
-                            raise ValueError(method + "is not a valid method.")
+                        binned_counts[i,k] += self.spectra[i][j][1]
                         break
                 if not included:
                     if tracking:
-                        print("M/Z value at position " + str(j) + \
-                              " of spectrum at index " + str(i) + \
-                              " discarded for not being in a bin.")
+                        logger.debug("M/Z value at position %d of spectrum at index %d discarded for not being in a bin.", j, i)
             # If method is by means, divide by peak count per bin
             if method == "mean":
                 for k in range(len(mz_bins)-1):
                     if peak_count[k] != 0:
                         binned_counts[i,k] /= peak_count[k]
-        # Normalize data
-        if normalize is None:
-            pass
-        elif normalize == "scale_ind":
-            binned_counts /= np.max(binned_counts, axis=1)
-        elif normalize == "scale_all":
-            binned_counts /= np.max(binned_counts)
-        elif normalize == "norm":
-            binned_counts /= np.array([la.norm(binned_counts, axis=1)]).T
-        else:
-            raise ValueError("Input", normalize, "is not a valid normalization method.")
         return binned_counts
     
     
@@ -715,12 +1751,14 @@ class MSData():
     
     
     def PCA(self, mz_bins, d=2, thresh=1.0, sex_segregate=None, method="sum", 
-            normalize=None, tracking=False):
+            normalize=None, tracking=False, backend="exact", n_oversamples=10, n_iter=4, 
+            chunk_size=100, random_state=None):
         """Project the binned spectra into a d-dimensional space 
         spanned by the first d principal components of the data. 
         Returns an Nxd array of projected data. If sex_segregate 
         is "M" or "F", only male or female data, respectively, are 
-        considered. See the bin_data docstring for more detailed 
+        considered. The backend argument selects the SVD, as in 
+        MFE_PCA. See the bin_data docstring for more detailed 
         information."""
         # Get the data
         data = self.bin_data(mz_bins, thresh, method, normalize, tracking)
@@ -728,12 +1766,10 @@ class MSData():
             data = data[self.sex == "M"]
         elif sex_segregate == "F":
             data = data[self.sex == "F"]
-        # Center the data
-        means = np.mean(data, axis=0)
+        # Get the principal axes of the data
+        means, Vt = _principal_axes(data, d, backend, n_oversamples, n_iter, chunk_size, random_state)
+        # Center the data and project onto the principal component space
         data -= means
-        # Get the svd of the data
-        U, S, Vt = la.svd(data)
-        # Project onto the principal component space
         projected_data = data.dot(Vt.T[:,:d])
         return projected_data
     
@@ -852,12 +1888,44 @@ class MSData():
 
 
 
+class _Spectra():
+    """A read-only list of mass spectra stored in CSR style, that is, 
+    as one (P,2) array of [m/z, counts] peaks for all of the spectra 
+    together and an array of offsets such that the peaks of spectrum i 
+    are peaks[offsets[i]:offsets[i+1]]. Indexing gives a (d,2) view 
+    into the peak array instead of a copy, so spectra[0][10] still 
+    gives the [m/z, counts] row at index 10 of the first spectrum."""
+    
+    def __init__(self, peaks, offsets):
+        self.peaks = peaks
+        self.offsets = offsets
+    
+    
+    def __len__(self):
+        return len(self.offsets)-1
+    
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("Spectrum index {} out of range.".format(i))
+        return self.peaks[self.offsets[i]:self.offsets[i+1]]
+    
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+
 class LC_MSData():
-    """A data structure containing an array with rows of the form 
-    [RT-start, RT-end, datapoints], where datapoints is a list of 
-    tuples of the form (m/z, counts). In other words, this holds 
-    a list of mass spectra along with the RT-interval over which 
-    each spectrum was taken. 
+    """A data structure containing a list of mass spectra along with 
+    the RT-interval over which each spectrum was taken. The peaks of all 
+    of the spectra are stored together in flat arrays, with an array of 
+    offsets marking where each spectrum starts and ends.
     
     Initializes with the name of a datafile in .csv format. The 
     parser argument indicates in which style the data in the file 
@@ -867,12 +1935,13 @@ class LC_MSData():
     
     Parameters:
         N (int): The number of spectra.
-        data (array): A length N array with rows of the form 
-            (RT-start, RT-end, RT-peak, datapoints), where datapoints 
-            is a list of tuples of the form (m/z, counts). For example, 
-            typing data[0][1] will give the final RT of the first 
-            interval, and data[0][2] will give the list of m/z 
-            values and associated counts for the first spectrum.
+        mz (array): A length P array of the m/z values of every peak 
+            of every spectrum, where P is the total number of peaks.
+        counts (array): A length P array of the counts of every peak 
+            of every spectrum. Indices match those of mz.
+        offsets (array): A length N+1 array of indices into mz and 
+            counts. The peaks of the spectrum at index i are at 
+            indices offsets[i] to offsets[i+1]-1.
         RT_start (array): A length N array of initial RT values. 
             For example, RT_start[10] gives the initial RT value of 
             the spectrum at index 10.
@@ -881,72 +1950,130 @@ class LC_MSData():
             spectrum at index 10.
         RT_peak (array): A length N array of peak RT values. For 
             example, RT_peak[10] gives the peak RT value of the 
-            spectrum at index 10.
-        spectra (array): A length N array of MS spectra. Each 
-            spectrum consists of (m/z, counts) tuples. For example, 
-            spectra[0][10] gives the (m/z, counts) tuple at index 10 
-            of the first spectrum.
+            spectrum at index 10. It is NaN for a spectrum whose header 
+            gives an RT window but no peak RT.
+        spectra (list): A length N list of MS spectra. Each spectrum 
+            is a view of the peak arrays with rows of the form [m/z, 
+            counts]. For example, spectra[0][10] gives the [m/z, counts] 
+            row at index 10 of the first spectrum.
+        data (array): A length N array with rows of the form 
+            (RT-start, RT-end, RT-peak, spectrum). For example, 
+            typing data[0][1] will give the final RT of the first 
+            interval, and data[0][3] will give the m/z values and 
+            associated counts for the first spectrum. This array is 
+            built each time it is accessed, so use the other attributes 
+            where possible.
+        bin_cache (_ScopedCache): This object's part of the 
+            module-level bin_cache of binned counts used by bin_data.
+        pyramid (BinPyramid, None): The fine binned counts made by 
+            build_pyramid, if any.
+        intensity_order (array, None): The permutation that sorts all 
+            of the peaks by counts, made by bin_data_sweep.
     
     Functions:
         bin_data(mz_bins, RT_bins, method): Returns an array of the 
             MS counts for each bin. The method parameter determines 
             if the counts are summed or averaged.
+        bin_data_sweep(mz_bins, RT_bins, thresholds, method): Returns 
+            the binned counts for each of several thresholds at once.
+        build_pyramid(mz_bins, RT_bins, thresh): Bins the data once at 
+            a fine m/z resolution so that bin_data can answer coarser 
+            nested m/z bins without reading the peaks again.
         plot_bins(mz_bins, RT_bins, N_labels, method): Plots a graph 
             of the binned data.: 
         """
     
     
     def __init__(self, filename, parser="1"):
-        # Read in the file
-        with open(filename, "r") as file:
-            csvreader = csv.reader(file)
-            raw_data = np.array([row for row in csvreader])
-        data = []
-        
-        # Search for the useable data the right way
-        if parser == "1":
-            # Set up regexes to determine retention time windows and peaks
-            RT_window_getter = re.compile(r"rt: (\d+\.\d\d\d)-(\d+\.\d\d\d)")
-            RT_peak_getter = re.compile(r"Cpd \d+: (\d+\.\d\d\d)")
-            for row in raw_data:
-                if row[0][0] == "#":
-                    search = re.search(RT_window_getter, row[0])
-                    # If a new RT is found, add another row to data
-                    if search:
-                        peak = float(re.search(RT_peak_getter, row[0]).group(1))
-                        data.append(np.array([float(search.group(1)), 
-                                              float(search.group(2)), 
-                                              peak, 
-                                              []]))
-                # If the row contains m/z values instead of RT values, add the mz values to the last row of data
-                else:
-                    data[-1][3].append((float(row[1]), float(row[2])))
-        
-        elif parser == "2":
-            # Skip the headers
-            for row in raw_data[3:]:
-                # This format gives only one peak per feature, all nicely organized by row
-                data.append(np.array([float(row[50]), 
-                                      float(row[33]), 
-                                      float(row[48]), 
-                                      [(float(row[28]), float(row[36]))]]))
-        
-        else:
-            raise ValueError("Parser {} is not a recognized parsing method.".format(parser))
+        parsed = parse_file(filename, parser)
+        # Each header with an RT window starts another spectrum, and the peaks after it belong to it
+        starts = ~np.isnan(parsed.RT_start)
+        header_spectrum = np.append(np.cumsum(starts)-1, -1)
+        peak_spectrum = header_spectrum[parsed.block]
+        kept = peak_spectrum >= 0
         # Fill in the different data holders
-        self.data = np.array(data)
-        self.N = len(data)
-        self.RT_start = self.data[:,0]
-        self.RT_end = self.data[:,1]
-        self.RT_peak = self.data[:,2]
-        self.spectra = self.data[:,3]
+        self.N = int(np.count_nonzero(starts))
+        self.RT_start = parsed.RT_start[starts]
+        self.RT_end = parsed.RT_end[starts]
+        self.RT_peak = parsed.RT_peak[starts]
+        peaks = np.empty((np.count_nonzero(kept), 2))
+        peaks[:,0] = parsed.mz[kept]
+        peaks[:,1] = parsed.abundance[kept]
+        offsets = np.zeros(self.N+1, dtype=np.int64)
+        np.cumsum(np.bincount(peak_spectrum[kept], minlength=self.N), out=offsets[1:])
+        self._set_peaks(peaks, offsets)
     
     
-    def bin_data(self, mz_bins, RT_bins, flat=True, thresh=1.0, method="sum", normalize=None, tracking=False):
+    def _set_peaks(self, peaks, offsets):
+        """Stores the given (P,2) array of [m/z, counts] peaks and sets 
+        up the mz, counts and spectra views of it."""
+        self.bin_cache = _ScopedCache(bin_cache)
+        self.pyramid = None
+        self.intensity_order = None
+        self.offsets = offsets
+        self.mz = peaks[:,0]
+        self.counts = peaks[:,1]
+        self.spectra = _Spectra(peaks, offsets)
+    
+    
+    def __getstate__(self):
+        # Send the peaks once instead of once for each view of them
+        state = self.__dict__.copy()
+        del state["mz"], state["counts"], state["spectra"], state["bin_cache"], state["intensity_order"]
+        state["peaks"] = self.spectra.peaks
+        return state
+    
+    
+    def __setstate__(self, state):
+        peaks = state.pop("peaks")
+        self.__dict__.update(state)
+        self._set_peaks(peaks, state["offsets"])
+    
+    
+    def save(self, filename):
+        """Saves the parsed arrays to an uncompressed .npz file so that 
+        they can be loaded again without re-parsing the .csv file."""
+        np.savez(filename, RT_start=self.RT_start, RT_end=self.RT_end, RT_peak=self.RT_peak, 
+                 peaks=self.spectra.peaks, offsets=self.offsets)
+    
+    
+    @classmethod
+    def load(cls, filename):
+        """Returns an LC_MSData object made from a .npz file written 
+        by save."""
+        new = cls.__new__(cls)
+        with np.load(filename) as arrays:
+            new.RT_start = arrays["RT_start"]
+            new.RT_end = arrays["RT_end"]
+            new.RT_peak = arrays["RT_peak"]
+            peaks = arrays["peaks"]
+            new.N = len(new.RT_peak)
+            new._set_peaks(peaks, arrays["offsets"])
+        return new
+    
+    
+    @property
+    def data(self):
+        """Builds the old object array of (RT-start, RT-end, RT-peak, 
+        spectrum) rows for callers that still index the data that way."""
+        data = np.empty((self.N, 4), dtype=object)
+        data[:,0] = self.RT_start
+        data[:,1] = self.RT_end
+        data[:,2] = self.RT_peak
+        for i in range(self.N):
+            data[i,3] = self.spectra[i]
+        return data
+    
+    
+    @_profiled("LC_MSData.bin_data")
+    def bin_data(self, mz_bins, RT_bins, flat=True, thresh=1.0, method="sum", normalize=None, tracking=False, 
+                 engine="numpy", sparse=False):
         """Returns an array of the MS counts for each bin. The method 
         parameter determines if the counts are summed or averaged. If 
         a spectrum has a value that does not fall into any bin, that 
-        value is discarded.
+        value is discarded. The counts are cached in bin_cache before 
+        normalization, so calling this again with the same bins, thresh, 
+        method, engine and sparse only redoes the normalization.
         
         Parameters: 
             mz_bins (list): The m/z values that delimit the m/z bins. 
@@ -972,8 +2099,250 @@ class LC_MSData():
                 flat=True, then the flattened vector is normalized.
             tracking (bool): Whether or not to print checkpoints. 
                 Checkpoints include, but are not limited to, when a 
-                value is discarded."""
+                value is discarded.
+            engine (str): If "numpy", the RT and m/z bins are found 
+                by binary search and the RTxm/z matrix is filled in a 
+                single pass. If "loop", each spectrum and peak is binned 
+                one at a time. The "loop" engine is much slower and is 
+                kept as a reference for checking the output of the 
+                "numpy" engine.
+            sparse (bool): If true, returns a scipy.sparse csr_matrix 
+                instead of an array, with shape (1, r*m) if flat=True. 
+                Only bins that have counts are stored, so fine m/z bins 
+                take little memory. Requires engine="numpy"."""
+        if method != "sum" and method != "mean":
+            raise ValueError("{} is not a valid method.".format(method))
+        if sparse and engine != "numpy":
+            raise ValueError("Engine {} cannot make sparse bins.".format(engine))
+        # Determine the counts for each bin, unless they are already cached
+        key = (_bins_key(mz_bins), _bins_key(RT_bins), thresh, method, engine, sparse)
+        binned_counts = self.bin_cache.get(key)
+        if _profiler is not None:
+            _profiler.count(cache_hits=binned_counts is not None)
+        if binned_counts is None:
+            # Use the pyramid if the m/z bins are nested in its fine bins
+            coarse = None
+            if engine == "numpy" and self.pyramid is not None and self.pyramid.key == (_bins_key(RT_bins), thresh):
+                coarse = self.pyramid.coarsen(mz_bins, method)
+            if sparse:
+                if coarse is None:
+                    coarse = self._bin_sparse(mz_bins, RT_bins, thresh, method, tracking)
+                binned_counts = coarse
+                self.bin_cache.put(key, binned_counts, binned_counts[0].nbytes + binned_counts[1].nbytes)
+            else:
+                if coarse is not None:
+                    binned_counts = np.zeros((len(RT_bins)-1)*(len(mz_bins)-1))
+                    binned_counts[coarse[0]] = coarse[1]
+                    binned_counts = binned_counts.reshape(len(RT_bins)-1, len(mz_bins)-1)
+                elif engine == "numpy":
+                    binned_counts = self._bin_numpy(mz_bins, RT_bins, thresh, method, tracking)
+                elif engine == "loop":
+                    binned_counts = self._bin_loop(mz_bins, RT_bins, thresh, method, tracking)
+                else:
+                    raise ValueError("Engine {} is not a valid binning engine.".format(engine))
+                self.bin_cache.put(key, binned_counts, binned_counts.nbytes)
+        if sparse:
+            bins, values = binned_counts
+            return self._normalize_sparse(bins, values.copy(), len(RT_bins)-1, len(mz_bins)-1, flat, normalize)
+        # Copy the counts so that the cached counts are never changed
+        return self._normalize(binned_counts.copy(), flat, normalize)
+    
+    
+    def _normalize(self, binned_counts, flat, normalize):
+        """Normalizes the given rxm array of binned counts in place and 
+        returns it, flattened if flat=True. See bin_data for the 
+        normalization methods."""
+        if normalize is None:
+            pass
+        elif normalize == "scale_ind":
+            binned_counts /= np.max(binned_counts, axis=1, keepdims=True)
+        elif normalize == "scale_all":
+            binned_counts /= np.max(binned_counts)
+        elif normalize == "norm" and not flat:
+            binned_counts /= np.array([la.norm(binned_counts, axis=1)]).T
+        elif normalize == "norm" and flat:
+            pass
+        else:
+            raise ValueError("Input", normalize, "is not a valid normalization method.")
+        if flat:
+            binned_counts = np.ravel(binned_counts)
+            if normalize == "norm":
+                binned_counts /= la.norm(binned_counts)
+        return binned_counts
+    
+    
+    @_profiled("LC_MSData.bin_data_sweep")
+    def bin_data_sweep(self, mz_bins, RT_bins, thresholds, flat=True, method="sum", normalize=None, tracking=False):
+        """Returns bin_data(mz_bins, RT_bins, flat, thresh, method, 
+        normalize) for each threshold in thresholds, stacked into a 
+        Tx(r*m) array, or a Txrxm array if flat=False. The peaks are 
+        binned once: each peak is given the first threshold that keeps 
+        it by cutting the intensity-sorted peaks (see intensity_order), 
+        and the counts for every threshold are then running sums over 
+        the thresholds. The raw counts for each threshold are also put 
+        in bin_cache, so later bin_data calls with these thresholds and 
+        sparse=False are free."""
+        if method != "sum" and method != "mean":
+            raise ValueError("{} is not a valid method.".format(method))
+        thresholds = np.asarray(thresholds, dtype=float)
+        sort = np.argsort(thresholds)
+        r = len(RT_bins)-1
+        m = len(mz_bins)-1
+        spectrum_idx, mz_vals, counts = self._flat_peaks()
+        
+        # Cut the sorted peaks at each threshold, relative to the maximum over all spectra
+        _progress(tracking, "Sorting peaks by intensity")
+        order = self._intensity_order()
+        sorted_counts = counts[order]
+        max_counts = sorted_counts[-1:] if len(counts) else np.zeros(1)
+        levels = np.empty(len(counts), dtype=int)
+        levels[order] = _threshold_levels(sorted_counts, [0], [len(counts)], max_counts, thresholds[sort])
+        
+        # Bin the peaks once and add them up over the thresholds
+        _progress(tracking, "Working on RT and m/z bins")
+        RT_bindex = _get_bindex(self.RT_peak, RT_bins)[spectrum_idx]
+        mz_bindex = _get_bindex(mz_vals, mz_bins)
+        in_bin = (mz_bindex != -1) & (RT_bindex != -1)
+        sweep = _sweep_counts(RT_bindex[in_bin]*m + mz_bindex[in_bin], counts[in_bin], levels[in_bin], 
+                              r*m, len(thresholds), method)
+        binned_counts = np.empty((len(thresholds), r*m) if flat else (len(thresholds), r, m))
+        for k, i in enumerate(sort):
+            raw_counts = sweep[k].reshape(r, m)
+            key = (_bins_key(mz_bins), _bins_key(RT_bins), thresholds[i], method, "numpy", False)
+            self.bin_cache.put(key, raw_counts, raw_counts.nbytes)
+            binned_counts[i] = self._normalize(raw_counts.copy(), flat, normalize)
+        return binned_counts
+    
+    
+    def _intensity_order(self):
+        """Returns the permutation that sorts all of the peaks by counts, 
+        computing it the first time."""
+        if self.intensity_order is None:
+            self.intensity_order = np.argsort(self.counts, kind="stable")
+        return self.intensity_order
+    
+    
+    def build_pyramid(self, mz_bins, RT_bins, thresh=1.0, tracking=False):
+        """Bins the data once with the fine m/z bins mz_bins. After this, 
+        bin_data answers any request with the same RT_bins, thresh and 
+        engine "numpy" whose m/z bin edges are all among these edges by 
+        adding up the fine bins, without reading the peaks again. This 
+        makes sweeps over m/z bin widths much faster."""
+        flat_idx, counts = self._bin_indices(mz_bins, RT_bins, thresh, tracking)
+        self.pyramid = BinPyramid(mz_bins, flat_idx, counts, (_bins_key(RT_bins), thresh))
+    
+    
+    def _flat_peaks(self):
+        """Returns the peaks of every spectrum as three flat arrays: 
+        the index of the spectrum each peak belongs to, the m/z value 
+        of each peak, and the counts of each peak."""
+        spectrum_idx = np.repeat(np.arange(self.N), np.diff(self.offsets))
+        return spectrum_idx, self.mz, self.counts
+    
+    
+    def _bin_indices(self, mz_bins, RT_bins, thresh, tracking):
+        """Finds the RT bin of each spectrum and the m/z bin of each peak 
+        by binary search. Returns the flattened (RT bin, m/z bin) index 
+        and the counts of each peak that falls into a bin and meets the 
+        threshold criteria."""
+        m = len(mz_bins)-1
+        spectrum_idx, mz_vals, counts = self._flat_peaks()
+        # Get the maximum value over all spectra for thresholding
+        max_counts = np.max(counts)
+        
+        # Determine the RT bin for each spectrum
+        _progress(tracking, "Working on RT bins")
+        RT_bindex = _get_bindex(self.RT_peak, RT_bins)
+        if tracking and logger.isEnabledFor(logging.DEBUG):
+            for i in np.flatnonzero(RT_bindex == -1):
+                logger.debug("Spectrum at index %d discarded for not being in a bin.", i)
+        
+        # Determine the m/z bin for each value in each spectrum
+        _progress(tracking, "Working on m/z bins")
+        mz_bindex = _get_bindex(mz_vals, mz_bins)
+        if tracking and logger.isEnabledFor(logging.DEBUG):
+            num_peaks = np.bincount(spectrum_idx, minlength=self.N)
+            positions = np.arange(len(mz_vals)) - np.repeat(np.cumsum(num_peaks) - num_peaks, num_peaks)
+            for j in np.flatnonzero(mz_bindex == -1):
+                logger.debug("M/Z value at position %d of spectrum at index %d discarded for not being in a bin.", 
+                             positions[j], spectrum_idx[j])
         
+        # Keep the counts that meet the threshold criteria
+        in_bins = (mz_bindex != -1) & (RT_bindex[spectrum_idx] != -1)
+        kept = in_bins & (counts <= thresh*max_counts)
+        if tracking or _profiler is not None:
+            n_outside = len(counts) - np.count_nonzero(in_bins)
+            _progress(tracking, "%d spectra and %d of %d peaks discarded for not being in a bin.", 
+                      np.count_nonzero(RT_bindex == -1), n_outside, len(counts))
+            if _profiler is not None:
+                n_binned = np.count_nonzero(kept)
+                _profiler.count(peaks_read=len(counts), peaks_outside_bins=n_outside, 
+                                peaks_above_thresh=len(counts) - n_outside - n_binned, peaks_binned=n_binned)
+        flat_idx = RT_bindex[spectrum_idx[kept]]*m + mz_bindex[kept]
+        return flat_idx, counts[kept]
+    
+    
+    def _bin_numpy(self, mz_bins, RT_bins, thresh, method, tracking):
+        """Bins every peak of every spectrum at once. The RT bin of each 
+        spectrum and the m/z bin of each peak are found by binary search, 
+        and the counts are added up per (RT bin, m/z bin) pair."""
+        r = len(RT_bins)-1
+        m = len(mz_bins)-1
+        flat_idx, counts = self._bin_indices(mz_bins, RT_bins, thresh, tracking)
+        # Add the counts to the appropriate bin aggregate
+        binned_counts = np.bincount(flat_idx, weights=counts, minlength=r*m).reshape(r, m)
+        # Divide if necessary for averaging
+        if method == "mean":
+            num_in_bin = np.bincount(flat_idx, minlength=r*m).reshape(r, m)
+            np.divide(binned_counts, num_in_bin, out=binned_counts, where=num_in_bin != 0)
+        return binned_counts
+    
+    
+    def _bin_sparse(self, mz_bins, RT_bins, thresh, method, tracking):
+        """Bins every peak of every spectrum at once like _bin_numpy, 
+        but only adds up the counts of the bins that have peaks. Returns 
+        the flattened (RT bin, m/z bin) index of each bin that has peaks 
+        and the counts in that bin."""
+        flat_idx, counts = self._bin_indices(mz_bins, RT_bins, thresh, tracking)
+        # Add the counts to the appropriate bin aggregate
+        bins, bin_of_peak = np.unique(flat_idx, return_inverse=True)
+        values = np.bincount(bin_of_peak, weights=counts, minlength=len(bins))
+        # Divide if necessary for averaging
+        if method == "mean":
+            values /= np.bincount(bin_of_peak, minlength=len(bins))
+        return bins, values
+    
+    
+    def _normalize_sparse(self, bins, values, r, m, flat, normalize):
+        """Normalizes the counts made by _bin_sparse in place and returns 
+        them as a csr_matrix. The normalization is done on the stored 
+        values, so empty RT bins stay zero when normalize is "scale_ind" 
+        or "norm"."""
+        RT_bindex = bins // m
+        if normalize is None:
+            pass
+        elif normalize == "scale_ind":
+            row_max = np.zeros(r)
+            np.maximum.at(row_max, RT_bindex, values)
+            values /= row_max[RT_bindex]
+        elif normalize == "scale_all":
+            values /= np.max(values)
+        elif normalize == "norm" and not flat:
+            row_norm = np.sqrt(np.bincount(RT_bindex, weights=values**2, minlength=r))
+            values /= row_norm[RT_bindex]
+        elif normalize == "norm" and flat:
+            values /= la.norm(values)
+        else:
+            raise ValueError("Input", normalize, "is not a valid normalization method.")
+        if flat:
+            return csr_matrix((values, (np.zeros(len(bins), dtype=int), bins)), shape=(1, r*m))
+        return csr_matrix((values, (RT_bindex, bins % m)), shape=(r, m))
+    
+    
+    def _bin_loop(self, mz_bins, RT_bins, thresh, method, tracking):
+        """Bins each peak of each spectrum one at a time by checking 
+        every bin. This is slow, but is kept as a reference for the 
+        output of _bin_numpy."""
         # Get the maximum value for the spectrum for thresholding
         max_counts = np.max([np.max([self.spectra[i][j][1] for j in range(len(self.spectra[i]))]) for i in range(self.N)])
         # Set up the framework for storing the counts for each bin
@@ -983,13 +2352,12 @@ class LC_MSData():
         
         # Determine the RT bin for each spectrum
         RT_centers = self.RT_peak
-        RT_bindex = np.zeros(self.N)
-        if tracking:
-            print("Working on RT bins")
+        RT_bindex = np.zeros(self.N, dtype=int)
+        _progress(tracking, "Working on RT bins")
         # Iterate over each spectrum
         for i in range(self.N):
             if tracking and i%(self.N//100 + 1) == 0:
-                print("Spectrum {} of {}".format(i, self.N))
+                logger.info("Spectrum %d of %d", i, self.N)
             included = False
             # Iterate over each RT bin
             for j in range(len(RT_bins)-1):
@@ -1000,16 +2368,14 @@ class LC_MSData():
             if not included:
                 RT_bindex[i] = -1
                 if tracking:
-                    print("Spectrum at index {} discarded for not being in a bin.".format(i))
+                    logger.debug("Spectrum at index %d discarded for not being in a bin.", i)
         
         # Determine the m/z bin for each value in each spectrum and add the value to that bin
-        mz_bindex = [[] for _ in range(self.N)]
-        if tracking:
-            print("Working on m/z bins")
+        _progress(tracking, "Working on m/z bins")
         # Iterate over each spectrum
         for i in range(self.N):
             if tracking and i%(self.N//100 + 1) == 0:
-                print("Spectrum {} of {}".format(i, self.N))
+                logger.info("Spectrum %d of %d", i, self.N)
             # Iterate over each (m/z, counts) tuple
             for j in range(len(self.spectra[i])):
                 included = False
@@ -1018,54 +2384,22 @@ class LC_MSData():
                 # Iterate over each potential m/z bin
                 for k in range(len(mz_bins)-1):
                     if mz_val >= mz_bins[k] and mz_val < mz_bins[k+1]:
-                        # Track the bin for each (m/z, counts) pair, just in case
-                        mz_bindex[i].append(k)
                         # Add the counts to the appropriate bin aggregate if it meets the threshold criteria
                         if counts <= thresh*max_counts and RT_bindex[i] != -1:
-                            if method == "sum":
-                                binned_counts[int(RT_bindex[i]), k] += counts
-                            elif method == "mean":
-                                binned_counts[RT_bindex[i], k] += counts
+                            binned_counts[RT_bindex[i], k] += counts
+                            if method == "mean":
                                 # num_in_bin defaults to infinity to prevent division by zero errors
                                 if num_in_bin[RT_bindex[i], k] == np.inf:
                                     num_in_bin[RT_bindex[i], k] = 0
                                 num_in_bin[RT_bindex[i], k] += 1
-                            else:
-                                raise ValueError("{} is not a valid method.".format(method))
                         included = True
                         break
                 if not included:
-                    mz_bindex[i].append(-1)
                     if tracking:
-                        print("M/Z value at position " + str(j) + \
-                              " of spectrum at index " + str(i) + \
-                              " discarded for not being in a bin.")
-        mz_bindex = np.array(mz_bindex)
+                        logger.debug("M/Z value at position %d of spectrum at index %d discarded for not being in a bin.", j, i)
         # Divide if necessary for averaging
         if method == "mean":
             binned_counts /= num_in_bin
-        
-        # Normalize data
-        if normalize is None:
-            pass
-        elif normalize == "scale_ind":
-            for i in range(len(RT_bins)-1):
-                binned_counts[i] /= np.max(binned_counts[i])
-        elif normalize == "scale_all":
-            scale = np.max(binned_counts)
-            for i in range(len(RT_bins)-1):
-                binned_counts[i] /= scale
-        elif normalize == "norm" and not flat:
-            for i in range(len(RT_bins)-1):
-                binned_counts[i] /= la.norm(binned_counts[i])
-        elif normalize == "norm" and flat:
-            pass
-        else:
-            raise ValueError("Input", normalize, "is not a valid normalization method.")
-        if flat:
-            binned_counts = np.ravel(binned_counts)
-            if normalize == "norm":
-                binned_counts /= la.norm(binned_counts)
         return binned_counts
     
     
@@ -1102,61 +2436,280 @@ class LC_MSData():
 
 
 
-def LC_MS_getter(path="C:\\Research\Data", parser="1", more_info=False, tracking=False):
+class LC_MSStore():
+    """A list of LC-MS runs stored on disk instead of in memory, for 
+    cohorts whose spectra do not all fit in memory at once. The peaks of 
+    every spectrum of every run are kept in one concatenated file of 
+    [m/z, counts] rows that is opened with np.memmap, and the offsets and 
+    RT values of the spectra are kept in a small index file.
+    
+    Initializes with the path of a directory made by LC_MS_getter with 
+    the store argument. Indexing gives an LC_MSData object whose peaks 
+    are views of the memory-mapped file, so only the parts of the file 
+    that are actually used are read from disk. A store can be given to 
+    LC_MS_binner and LC_MS_PCA in place of a list of LC_MSData objects.
+    
+    Attributes:
+        n_runs (int): The number of runs.
+        peaks (memmap): A (P,2) array of the [m/z, counts] peaks of 
+            every spectrum of every run.
+        offsets (array): A length S+1 array of indices into peaks, 
+            where S is the total number of spectra. The peaks of 
+            spectrum s are at indices offsets[s] to offsets[s+1]-1.
+        RT (array): An Sx3 array with rows of the form [RT-start, 
+            RT-end, RT-peak] for every spectrum.
+        runs (array): A length n_runs+1 array of indices into the 
+            spectra. The spectra of run i are at indices runs[i] to 
+            runs[i+1]-1.
+        """
+    
+    
+    def __init__(self, path):
+        with np.load(os.path.join(path, "index.npz")) as index:
+            self.offsets = index["offsets"]
+            self.RT = index["RT"]
+            self.runs = index["runs"]
+        self.n_runs = len(self.runs)-1
+        # np.memmap cannot map an empty file
+        if self.offsets[-1] == 0:
+            self.peaks = np.empty((0,2))
+        else:
+            self.peaks = np.memmap(os.path.join(path, "peaks.dat"), dtype=float, mode="r", 
+                                   shape=(int(self.offsets[-1]), 2))
+    
+    
+    def __len__(self):
+        return self.n_runs
+    
+    
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n_runs
+        if i < 0 or i >= self.n_runs:
+            raise IndexError("Run index {} out of range.".format(i))
+        first, last = self.runs[i], self.runs[i+1]
+        run = LC_MSData.__new__(LC_MSData)
+        run.N = int(last - first)
+        run.RT_start = self.RT[first:last,0]
+        run.RT_end = self.RT[first:last,1]
+        run.RT_peak = self.RT[first:last,2]
+        offsets = self.offsets[first:last+1]
+        run._set_peaks(self.peaks[offsets[0]:offsets[-1]], offsets - offsets[0])
+        return run
+    
+    
+    def __iter__(self):
+        for i in range(self.n_runs):
+            yield self[i]
+
+
+
+class _LC_MSStoreWriter():
+    """Writes LC_MSData objects one at a time to a new LC_MSStore in the 
+    directory "path", so that only one run needs to be in memory while 
+    the store is made."""
+    
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.peak_file = open(os.path.join(path, "peaks.dat"), "wb")
+        self.offsets = [np.zeros(1, dtype=np.int64)]
+        self.RT = []
+        self.runs = [0]
+        self.n_peaks = 0
+    
+    
+    def append(self, run):
+        """Adds the peaks and index of the given LC_MSData object to the 
+        end of the store."""
+        np.ascontiguousarray(run.spectra.peaks, dtype=float).tofile(self.peak_file)
+        self.offsets.append(self.n_peaks + np.asarray(run.offsets[1:], dtype=np.int64))
+        self.RT.append(np.column_stack([run.RT_start, run.RT_end, run.RT_peak]).reshape(-1,3))
+        self.runs.append(self.runs[-1] + run.N)
+        self.n_peaks += len(run.spectra.peaks)
+    
+    
+    def close(self):
+        """Writes the index file and returns the finished LC_MSStore."""
+        self.peak_file.close()
+        RT = np.concatenate(self.RT) if self.RT else np.zeros((0,3))
+        np.savez(os.path.join(self.path, "index.npz"), offsets=np.concatenate(self.offsets), RT=RT, 
+                 runs=np.array(self.runs, dtype=np.int64))
+        return LC_MSStore(self.path)
+
+
+
+# The version of the LC_MSData parsing code. Bump this whenever parsing 
+# changes so that cached runs from older versions are not used.
+_PARSER_VERSION = 2
+# The name of the directory, next to the data, that holds cached runs
+_CACHE_DIR = ".lcms_cache"
+# The number of cache hits and misses in LC_MS_getter so far
+cache_stats = {"hits": 0, "misses": 0}
+
+
+
+def _cache_prefix(filename):
+    """Returns the start of the names of the cache files for the given 
+    .csv file, which is its base name followed by a hash of its full 
+    path, so that files of the same name in different directories 
+    never share or replace each other's cache files."""
+    digest = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:16]
+    return os.path.basename(filename) + "." + digest + "."
+
+
+def _cache_name(filename, parser):
+    """Returns the name of the cache file for the given .csv file. The 
+    name is _cache_prefix followed by a hash of the file's path, size 
+    and modification time and the parser and its version, so that any 
+    change to the file or to the parsing gives a different name."""
+    stat = os.stat(filename)
+    key = "|".join([os.path.abspath(filename), str(stat.st_size), str(stat.st_mtime_ns), 
+                    str(parser), str(_PARSER_VERSION)])
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return _cache_prefix(filename) + digest + ".npz"
+
+
+def _is_cache_file(name, prefix):
+    """Returns whether name is a cache file name made by _cache_name 
+    for the .csv file with the given _cache_prefix."""
+    return name.startswith(prefix) and name.endswith(".npz") and len(name) == len(prefix) + 40 + len(".npz")
+
+
+
+def _cached_LC_MSData(filename, parser, cache_dir):
+    """Returns an LC_MSData object for the given .csv file along with 
+    whether it was loaded from the cache. On a miss, the file is parsed 
+    and the result is written to cache_dir, replacing any older cached 
+    versions of the same file."""
+    cache_file = os.path.join(cache_dir, _cache_name(filename, parser))
+    if os.path.exists(cache_file):
+        try:
+            return LC_MSData.load(cache_file), True
+        except (OSError, ValueError, KeyError):
+            pass
+    data = LC_MSData(filename, parser=parser)
+    # Writing the cache is optional, so a read-only data directory is not an error
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = _cache_prefix(filename)
+        for name in os.listdir(cache_dir):
+            if _is_cache_file(name, prefix):
+                os.remove(os.path.join(cache_dir, name))
+        # Write to a temporary file first so that other processes never see a partial file
+        temp_file = cache_file[:-len(".npz")] + ".{}.tmp.npz".format(os.getpid())
+        data.save(temp_file)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass
+    return data, False
+
+
+
+def _uncached_LC_MSData(filename, parser):
+    """Returns an LC_MSData object for the given .csv file along with 
+    False, to match the output of _cached_LC_MSData."""
+    return LC_MSData(filename, parser=parser), False
+
+
+
+def clear_cache(path="C:\\Research\Data"):
+    """Deletes every cached run in the cache directories under the 
+    directory "path" and returns the number of files deleted."""
+    n_deleted = 0
+    for root, dirs, files in os.walk(os.path.abspath(path)):
+        if os.path.basename(root) == _CACHE_DIR:
+            for filename in files:
+                if filename.endswith(".npz"):
+                    os.remove(os.path.join(root, filename))
+                    n_deleted += 1
+    return n_deleted
+
+
+
+@_profiled("LC_MS_getter")
+def LC_MS_getter(path="C:\\Research\Data", parser="1", more_info=False, tracking=False, workers=None, cache=True, 
+                 store=None):
     """Takes the name "path" of a directory and returns a list of LC_MSData 
-    objects created from all of the .csv files in the path. The "parser" 
-    argument indicates the structure of the stored data to make sure that the 
-    files are parsed correctly. If more_info=True, then two additional lists 
-    are returned. The first of the new lists contains floats representing the 
-    CDR (Clinical Dementia Rating) of each sample. The second contains the sex 
-    of each patient contributing the samples. Note that the method for extracting 
-    this information depends on the parser."""
-    # Initialize the list for storing data
+    objects created from all of the .csv files in the path, in order of file 
+    name. The "parser" argument indicates the structure of the stored data to 
+    make sure that the files are parsed correctly. If more_info=True, then two 
+    additional lists are returned. The first of the new lists contains floats 
+    representing the CDR (Clinical Dementia Rating) of each sample. The second 
+    contains the sex of each patient contributing the samples. Note that the 
+    method for extracting this information depends on the parser. If workers 
+    is greater than 1, the files are parsed in a pool of that many processes. 
+    If cache=True, each parsed file is saved in a hidden directory in "path" 
+    and loaded from there on later calls until the file changes. The numbers 
+    of files loaded from the cache and parsed are counted in cache_stats. If 
+    "store" is the name of a directory, the runs are written one at a time to 
+    an LC_MSStore in that directory, which is returned in place of the list."""
+    # Initialize the list or store for storing data
     LCMS_list = []
+    if store is not None:
+        writer = _LC_MSStoreWriter(store)
     # If specified, make regexes and lists for extracting data from file names
     if more_info:
+        if parser != "1" and parser != "2":
+            raise ValueError("Parser {} is not a valid parser".format(parser))
         cdr_finder = re.compile(r"\d*[_ ]+\w([0-4]{1,2}) ")
         sex_finder = re.compile(r"\d*[_ ]+(M|F)\d* ")
         cdr = []
         sex = []
     # Get the path from which the files are to be taken
     directory = os.path.abspath(path)
-    # Get and parse all of the files
+    # Get the names of all of the files in a fixed order
+    filenames = []
+    filepaths = []
     for root, dirs, files in os.walk(directory):
-        for filename in files:
-            if tracking:
-                print(filename)
+        for filename in sorted(files):
             if filename.endswith(".csv") or filename.endswith(".CSV"):
-                # Add the data to the list
-                LCMS_list.append(LC_MSData(path+"\\"+filename, parser=parser))
-                # If specified, get the sex and CDR corresponding to each sample
-                if more_info:
-                    if parser == "1" or parser == "2":
-                        # Look for sample cdr
-                        cdr_search = re.search(cdr_finder, filename)
-                        if cdr_search:
-                            # Check for non-integer CDR values
-                            cdr_str = cdr_search.group(1)
-                            if len(cdr_str) == 1:
-                                cdr.append(float(cdr_search.group(1)))
-                            elif len(cdr_str) > 1:
-                                first_digit = int(cdr_str[0])
-                                second_digit = int(cdr_str[2])
-                                cdr.append(first_digit + 0.1*second_digit)
-                            else:
-                                cdr.append(-1)
-                        # Append -1 if no CDR is found
-                        else:
-                            cdr.append(-1)
-                        # Look for sample sex
-                        sex_search = re.search(sex_finder, filename)
-                        if sex_search:
-                            sex.append(sex_search.group(1))
-                        # Append "O" for "Other" if no sex is found
-                        else:
-                            sex.append("O")
-                    else:
-                        raise ValueError("Parser {} is not a valid parser".format(parse))
+                filenames.append(filename)
+                filepaths.append(os.path.join(root, filename))
+    # Parse all of the files, in parallel if specified
+    if cache:
+        get_file = partial(_cached_LC_MSData, cache_dir=os.path.join(path, _CACHE_DIR))
+    else:
+        get_file = _uncached_LC_MSData
+    LCMS_data = _map_files(get_file, filepaths, parser, workers)
+    for filename, ((data, hit), seconds) in zip(filenames, LCMS_data):
+        if hit:
+            cache_stats["hits"] += 1
+        else:
+            cache_stats["misses"] += 1
+        _progress(tracking, "%s %s in %.2f s", filename, "loaded from cache" if hit else "parsed", seconds)
+        # Add the data to the list or store
+        if store is not None:
+            writer.append(data)
+        else:
+            LCMS_list.append(data)
+        # If specified, get the sex and CDR corresponding to each sample
+        if more_info:
+            # Look for sample cdr
+            cdr_search = re.search(cdr_finder, filename)
+            if cdr_search:
+                # Check for non-integer CDR values
+                cdr_str = cdr_search.group(1)
+                if len(cdr_str) == 1:
+                    cdr.append(float(cdr_search.group(1)))
+                elif len(cdr_str) > 1:
+                    first_digit = int(cdr_str[0])
+                    second_digit = int(cdr_str[2])
+                    cdr.append(first_digit + 0.1*second_digit)
+                else:
+                    cdr.append(-1)
+            # Append -1 if no CDR is found
+            else:
+                cdr.append(-1)
+            # Look for sample sex
+            sex_search = re.search(sex_finder, filename)
+            if sex_search:
+                sex.append(sex_search.group(1))
+            # Append "O" for "Other" if no sex is found
+            else:
+                sex.append("O")
+    if store is not None:
+        LCMS_list = writer.close()
     # Return the data as appropriate
     if more_info:
         return LCMS_list, cdr, sex
@@ -1164,69 +2717,548 @@ def LC_MS_getter(path="C:\\Research\Data", parser="1", more_info=False, tracking
 
 
 
-def LC_MS_binner(data, mz_bins, RT_bins, thresh=1.0, method="sum", normalize=None, tracking=False):
-    """Returns an n-darray of the binned data from each LC_MSData object in "data"."""
+@_profiled("LC_MS_binner")
+def LC_MS_binner(data, mz_bins, RT_bins, thresh=1.0, method="sum", normalize=None, tracking=False, sparse=False):
+    """Returns an n-darray of the binned data from each LC_MSData object in "data". 
+    "data" may also be an LC_MSStore, in which case the runs are read from disk 
+    one at a time. If "sparse" is True, a scipy.sparse csr_matrix is returned 
+    instead, which only stores the bins that have counts."""
     N = len(data)
     r = len(RT_bins)-1
     m = len(mz_bins)-1
+    if sparse:
+        rows = []
+        for i in range(N):
+            _progress(tracking, "Run %d of %d", i, N)
+            rows.append(data[i].bin_data(mz_bins, RT_bins, True, thresh, method, normalize, tracking, sparse=True))
+        return sp.vstack(rows, format="csr") if rows else csr_matrix((0, r*m))
     binned_data = np.zeros((N, r*m))
     for i in range(N):
-        if tracking:
-            print(i)
+        _progress(tracking, "Run %d of %d", i, N)
         binned_data[i] = data[i].bin_data(mz_bins, RT_bins, True, thresh, method, normalize, tracking)
     return binned_data
 
 
 
+def LC_MS_pyramid(data, mz_bins, RT_bins, thresh=1.0, tracking=False):
+    """Builds a pyramid of fine binned counts on each LC_MSData object in 
+    "data" so that LC_MS_binner can answer any coarser nested m/z bins with 
+    the same RT_bins and thresh without reading the peaks again. The runs of 
+    an LC_MSStore are made fresh each time they are indexed, so they do not 
+    keep their pyramids."""
+    for i in range(len(data)):
+        _progress(tracking, "Run %d of %d", i, len(data))
+        data[i].build_pyramid(mz_bins, RT_bins, thresh, tracking)
+
+
+
+@_profiled("LC_MS_PCA")
 def LC_MS_PCA(data, d, mz_bins, RT_bins, thresh=1.0, method="sum", normalize=None, 
-              pre_binned=False, get_V=False, tracking=False):
-    """Does PCA on a given set of LC_MSData objects. Uses sparse matrices for SVD.
-    If "pre_binned" is True, then assumes that "data" is a numpy array. If "get_V" 
-    is true, then the projection matrix Vt is also returned.
+              pre_binned=False, get_V=False, tracking=False, backend="exact", n_oversamples=10, 
+              n_iter=4, chunk_size=100, random_state=None):
+    """Does PCA on a given set of LC_MSData objects. Uses sparse matrices for SVD, 
+    and centers the data implicitly so that the dense centered matrix is never made.
+    If "pre_binned" is True, then assumes that "data" is a numpy array or a 
+    scipy.sparse matrix. If "get_V" is true, then the projection matrix Vt of the 
+    first d principal axes is also returned.
     Parameters:
-        data (list): A list of LC_MSData objects
-        d (int): The number of principal components to use"""
+        data (list): A list of LC_MSData objects or an LC_MSStore
+        d (int): The number of principal components to use
+        backend (str): The SVD used for PCA. "exact" finds the top d singular 
+            vectors with ARPACK. "randomized" uses a randomized SVD with 
+            n_oversamples extra samples of the range, n_iter power iterations, 
+            and the seed random_state. "incremental" fits an IncrementalPCA to 
+            chunk_size samples at a time; unless the data are pre-binned, each 
+            chunk of samples is binned as it is needed, so the whole binned 
+            matrix is never in memory."""
+    # Bin and fit the data a chunk at a time if specified
+    if backend == "incremental" and not pre_binned:
+        chunks = _chunks(len(data), chunk_size, d)
+        ipca = IncrementalPCA(n_components=d)
+        for start, end in chunks:
+            _progress(tracking, "Fitting samples %d to %d", start, end-1)
+            chunk = LC_MS_binner([data[i] for i in range(start, end)], mz_bins, RT_bins, thresh, 
+                                 method, normalize, tracking, sparse=True)
+            ipca.partial_fit(chunk.toarray())
+        # Bin the data again to project it onto the principal component space
+        projected_data = np.zeros((len(data), d))
+        for start, end in chunks:
+            _progress(tracking, "Projecting samples %d to %d", start, end-1)
+            chunk = LC_MS_binner([data[i] for i in range(start, end)], mz_bins, RT_bins, thresh, 
+                                 method, normalize, tracking, sparse=True)
+            projected_data[start:end] = ipca.transform(chunk.toarray())
+        if get_V:
+            return projected_data, ipca.components_
+        return projected_data
+    
     # Get the useful information out of the data
     if pre_binned:
         binned_data = data
     else:
-        binned_data = LC_MS_binner(data, mz_bins, RT_bins, thresh, method, normalize, tracking)
-    # Center the data
-    means = np.mean(binned_data, axis=0)
-    binned_data -= means
-    # Sparsify
-    sparse_data = csr_matrix(binned_data)
+        binned_data = LC_MS_binner(data, mz_bins, RT_bins, thresh, method, normalize, tracking, sparse=True)
     # Get the svd of the data
-    if tracking:
-        print("SVD")
-    U, S, Vt = spla.svds(sparse_data)
-    if tracking:
-        print("Shape of U:",U.shape)
-        print("Shape of S:",S.shape)
-        print("Shape of Vt:",Vt.shape)
-    # Project onto the principal component space
-    if tracking:
-        print("Projecting")
-    projected_data = binned_data.dot(Vt.T[:,:d])
+    _progress(tracking, "SVD")
+    with _stage("LC_MS_PCA.svd"):
+        means, Vt = _principal_axes(binned_data, d, backend, n_oversamples, n_iter, chunk_size, random_state)
+    Vt = Vt[:d]
+    _progress(tracking, "Shape of Vt: %s", Vt.shape)
+    # Project the centered data onto the principal component space
+    _progress(tracking, "Projecting")
+    with _stage("LC_MS_PCA.project"):
+        projected_data = binned_data @ Vt.T - means @ Vt.T
     if get_V:
         return projected_data, Vt
     return projected_data
 
 
 
-def LC_MS_kPCA(data, labels, mz_bins, RT_bins, thresh=1.0, method="sum", classifier="RF", normalize=None, tracking=False):
+class LC_MSArchive():
+    """A binned matrix and PCA projection of LC-MS runs that is kept on 
+    disk and grows one run at a time, for ingesting new instrument 
+    exports without re-binning the runs that came before them. The 
+    binned rows are kept in sparse CSR form, so only the bins with 
+    counts take up space. Their values and column indices, along with 
+    the projected rows, are kept in files that are appended to and 
+    opened with np.memmap, and the row offsets, file names, binning 
+    settings and principal axes are kept in a small index file. 
+    
+    Initializes with the path of a directory. If the directory already 
+    holds an archive, it is opened and the other arguments are ignored. 
+    Otherwise a new archive is made with the given binning settings, 
+    which are those of LC_MSData.bin_data. The principal axes are fit 
+    once fit_after runs have been added, after which each new run is 
+    projected onto the same axes, so earlier rows never change. Call 
+    refit to fit the axes again to every run in the archive. 
+    
+    Attributes: 
+        n_rows (int): The number of runs. 
+        names (list): A length n_rows list of the file names of the runs. 
+        mz_bins (array): The m/z bin edges. 
+        RT_bins (array): The RT bin edges. 
+        d (int): The number of principal components. 
+        binned (csr_matrix): An n_rows x (r*m) sparse matrix of the 
+            binned runs, whose data and indices are memmaps. 
+        projection (memmap): An n_rows x d array of the binned runs 
+            projected onto the principal axes, with no rows until the 
+            axes are fit. 
+        means (array, None): The mean binned run the axes were fit to. 
+        Vt (array, None): The dx(r*m) array of principal axes. 
+        """
+    
+    
+    def __init__(self, path, mz_bins=None, RT_bins=None, d=2, thresh=1.0, method="sum", normalize=None,
+                 fit_after=10):
+        self.path = path
+        if os.path.exists(os.path.join(path, "index.npz")):
+            with np.load(os.path.join(path, "index.npz")) as index:
+                if "indptr" not in index:
+                    raise ValueError("The archive in {} was made by an older version and must be rebuilt".format(path))
+                self.names = index["names"].tolist()
+                self.indptr = index["indptr"]
+                self.mz_bins = index["mz_bins"]
+                self.RT_bins = index["RT_bins"]
+                self.d = int(index["d"])
+                self.thresh = float(index["thresh"])
+                self.method = str(index["method"])
+                self.normalize = str(index["normalize"]) or None
+                self.fit_after = int(index["fit_after"])
+                self.means = index["means"] if "means" in index else None
+                self.Vt = index["Vt"] if "Vt" in index else None
+        else:
+            if mz_bins is None or RT_bins is None:
+                raise ValueError("No archive in {}, so mz_bins and RT_bins are needed to make one".format(path))
+            if fit_after <= d:
+                raise ValueError("fit_after must be greater than d, not {}".format(fit_after))
+            os.makedirs(path, exist_ok=True)
+            self.names = []
+            self.indptr = np.zeros(1, dtype=np.int64)
+            self.mz_bins = np.asarray(mz_bins, dtype=float)
+            self.RT_bins = np.asarray(RT_bins, dtype=float)
+            self.d = d
+            self.thresh = thresh
+            self.method = method
+            self.normalize = normalize
+            self.fit_after = fit_after
+            self.means = None
+            self.Vt = None
+            self._write_index()
+        self.n_rows = len(self.names)
+        self.width = (len(self.RT_bins)-1)*(len(self.mz_bins)-1)
+    
+    
+    def __len__(self):
+        return self.n_rows
+    
+    
+    def _open(self, name, shape, dtype=float):
+        """Returns the given data file as a read-only memmap of the given 
+        shape, which covers only the part of the file in the index."""
+        # np.memmap cannot map an empty file
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=shape)
+    
+    
+    @property
+    def binned(self):
+        n_values = int(self.indptr[-1])
+        return csr_matrix((self._open("data.dat", (n_values,)), self._open("indices.dat", (n_values,), np.int64), 
+                           self.indptr), shape=(self.n_rows, self.width))
+    
+    
+    @property
+    def projection(self):
+        return self._open("projection.dat", (self.n_rows if self.Vt is not None else 0, self.d))
+    
+    
+    def _write_values(self, name, start, values):
+        """Writes the given array to the given data file starting at 
+        element "start" of the flattened file, dropping anything after 
+        it. Values past the end of the index are left over from an 
+        interrupted append, so they are overwritten."""
+        filename = os.path.join(self.path, name)
+        with open(filename, "r+b" if os.path.exists(filename) else "wb") as file:
+            file.seek(start*values.itemsize)
+            np.ascontiguousarray(values).tofile(file)
+            file.truncate()
+    
+    
+    def _write_index(self):
+        """Writes the index file, through a temporary file so that the 
+        archive is never left with a partial index."""
+        index = {"names": np.array(self.names, dtype=str), "indptr": self.indptr, 
+                 "mz_bins": self.mz_bins, "RT_bins": self.RT_bins,
+                 "d": self.d, "thresh": self.thresh, "method": self.method, "normalize": self.normalize or "",
+                 "fit_after": self.fit_after}
+        if self.Vt is not None:
+            index["means"] = self.means
+            index["Vt"] = self.Vt
+        temp_file = os.path.join(self.path, "index.{}.tmp.npz".format(os.getpid()))
+        np.savez(temp_file, **index)
+        os.replace(temp_file, os.path.join(self.path, "index.npz"))
+    
+    
+    def append(self, names, runs, tracking=False):
+        """Bins the given LC_MSData objects, adds them to the end of the 
+        archive under the given file names, and projects them onto the 
+        principal axes, fitting the axes first if there are now enough 
+        runs. Returns the rows of the projection that were added."""
+        if len(runs) == 0:
+            return np.empty((0, self.d))
+        binned_data = LC_MS_binner(runs, self.mz_bins, self.RT_bins, self.thresh, self.method,
+                                   self.normalize, tracking, sparse=True)
+        binned_data.sort_indices()
+        self._write_values("data.dat", int(self.indptr[-1]), binned_data.data.astype(float))
+        self._write_values("indices.dat", int(self.indptr[-1]), binned_data.indices.astype(np.int64))
+        start = self.n_rows
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + binned_data.indptr[1:].astype(np.int64)])
+        self.names += list(names)
+        self.n_rows = len(self.names)
+        if self.Vt is None:
+            if self.n_rows < self.fit_after:
+                self._write_index()
+                return np.empty((0, self.d))
+            # Fitting the axes for the first time projects every run so far
+            self.refit(tracking=tracking)
+            return np.asarray(self.projection)
+        projected_data = binned_data @ self.Vt.T - self.means @ self.Vt.T
+        self._write_values("projection.dat", start*self.d, projected_data)
+        self._write_index()
+        return projected_data
+    
+    
+    def refit(self, backend="exact", chunk_size=100, tracking=False):
+        """Fits the principal axes to every run in the archive and 
+        projects every run onto them again. This reads the sparse binned 
+        matrix straight from the memmaps but does not parse or bin any 
+        runs. The backend is that of LC_MS_PCA, and "incremental" reads 
+        chunk_size runs at a time."""
+        _progress(tracking, "Fitting the principal axes to %d runs", self.n_rows)
+        binned_data = self.binned
+        means, Vt = _principal_axes(binned_data, self.d, backend, chunk_size=chunk_size)
+        self.means = means
+        self.Vt = Vt[:self.d]
+        self._write_values("projection.dat", 0, binned_data @ self.Vt.T - self.means @ self.Vt.T)
+        self._write_index()
+
+
+
+def _landed_files(path, skip):
+    """Returns a dictionary from the name of each .csv file directly in 
+    the directory "path" that is not in skip to its (size, modification 
+    time)."""
+    landed = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(".csv") and entry.name not in skip:
+                stat = entry.stat()
+                landed[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return landed
+
+
+
+@_profiled("LC_MS_ingest")
+def LC_MS_ingest(path, archive, parser="1", filenames=None, workers=None, tracking=False):
+    """Parses the .csv files in the directory "path" that are not yet in 
+    the LC_MSArchive "archive", in order of file name, and appends them 
+    to it. Parsed files are written to the same cache as LC_MS_getter 
+    uses. If filenames is given, only those files are considered. Files 
+    that change after they are added are not added again. Returns the 
+    names of the files added."""
+    if filenames is None:
+        filenames = _landed_files(path, set(archive.names))
+    filenames = sorted(set(filenames) - set(archive.names))
+    if not filenames:
+        return []
+    get_file = partial(_cached_LC_MSData, cache_dir=os.path.join(path, _CACHE_DIR))
+    runs = []
+    for filename, ((data, hit), seconds) in zip(filenames, _map_files(get_file, [os.path.join(path, filename)
+                                                                                for filename in filenames],
+                                                                      parser, workers)):
+        cache_stats["hits" if hit else "misses"] += 1
+        _progress(tracking, "%s %s in %.2f s", filename, "loaded from cache" if hit else "parsed", seconds)
+        runs.append(data)
+    archive.append(filenames, runs, tracking)
+    return filenames
+
+
+
+def _open_inotify(path):
+    """Returns an INotify object that reports files in the directory 
+    "path" being written or moved in, or None if inotify is not 
+    available. The caller closes it when done."""
+    if INotify is None:
+        return None
+    inotify = None
+    try:
+        inotify = INotify()
+        inotify.add_watch(path, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+    except OSError:
+        if inotify is not None:
+            inotify.close()
+        return None
+    return inotify
+
+
+
+def LC_MS_watch(path, archive, parser="1", interval=5.0, max_polls=None, workers=None, tracking=False,
+                callback=None):
+    """Watches the directory "path" for new .csv files and appends each 
+    one to the LC_MSArchive "archive" with LC_MS_ingest, so the work done 
+    grows with the new files rather than with the whole archive. The 
+    directory is checked whenever inotify reports a finished file, or 
+    every interval seconds if inotify is not available. A file is only 
+    added once its size and modification time are the same on two 
+    checks in a row, so that exports that are still being written are 
+    left for later. 
+    
+    Runs until interrupted or until the directory has been checked 
+    max_polls times, then returns the archive. If callback is given, it 
+    is called with the archive and the names of the files added after 
+    each check that adds any."""
+    inotify = _open_inotify(path)
+    _progress(tracking, "Watching %s %s", path, "with inotify" if inotify is not None else "by polling")
+    last_seen = {}
+    n_polls = 0
+    try:
+        while max_polls is None or n_polls < max_polls:
+            landed = _landed_files(path, set(archive.names))
+            settled = [name for name, stat in landed.items() if last_seen.get(name) == stat]
+            last_seen = landed
+            added = LC_MS_ingest(path, archive, parser, settled, workers, tracking)
+            if added:
+                _progress(tracking, "Added %d files, %d runs in the archive", len(added), len(archive))
+                if callback is not None:
+                    callback(archive, added)
+            n_polls += 1
+            if max_polls is not None and n_polls >= max_polls:
+                break
+            # Check again soon if files are still settling, since inotify will not report them again
+            if inotify is None or len(settled) < len(landed):
+                time.sleep(interval)
+            else:
+                inotify.read(timeout=int(interval*1000))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if inotify is not None:
+            inotify.close()
+    return archive
+
+
+
+class _CachedKernelPCA(BaseEstimator, TransformerMixin):
+    """KernelPCA on kernel matrices that were computed ahead of time for 
+    the whole cohort and saved as .npy files. The "samples" passed to fit 
+    and transform are a column of row indices into the kernel matrices, 
+    so a search over kernels only slices the memory-mapped matrices 
+    instead of recomputing them in every fold and worker.
+    
+    Parameters:
+        kernel_files (dict): Maps "kernel,gamma" to the .npy file of 
+            that kernel matrix.
+        kernel (str): The kernel to use.
+        gamma (float): The gamma of the kernel, as in kernel_files.
+        n_components (int): The number of kernel principal components."""
+    
+    def __init__(self, kernel_files=None, kernel="linear", gamma=None, n_components=2):
+        self.kernel_files = kernel_files
+        self.kernel = kernel
+        self.gamma = gamma
+        self.n_components = n_components
+    
+    
+    def _kernel(self):
+        return np.load(self.kernel_files["{},{}".format(self.kernel, self.gamma)], mmap_mode="r")
+    
+    
+    def fit(self, X, y=None):
+        self.fit_idx_ = np.asarray(X, dtype=int).ravel()
+        K = self._kernel()
+        self.kpca_ = KernelPCA(n_components=self.n_components, kernel="precomputed")
+        self.kpca_.fit(np.asarray(K[np.ix_(self.fit_idx_, self.fit_idx_)]))
+        return self
+    
+    
+    def transform(self, X):
+        idx = np.asarray(X, dtype=int).ravel()
+        K = self._kernel()
+        return self.kpca_.transform(np.asarray(K[np.ix_(idx, self.fit_idx_)]))
+
+
+
+def _kernel_matrix(gram, kernel, gamma, degree=3, coef0=1.0):
+    """Returns the kernel matrix of the samples with the given Gram 
+    matrix X X^T, with the same definitions of the kernels as 
+    sklearn.metrics.pairwise."""
+    if kernel == "linear":
+        return gram
+    if kernel == "poly":
+        return (gamma*gram + coef0)**degree
+    if kernel == "sigmoid":
+        return np.tanh(gamma*gram + coef0)
+    norms = np.diag(gram)
+    if kernel == "rbf":
+        return np.exp(-gamma*np.maximum(norms[:,None] + norms[None,:] - 2*gram, 0))
+    if kernel == "cosine":
+        norms = np.sqrt(norms)
+        norms[norms == 0] = 1
+        return gram/np.outer(norms, norms)
+    raise ValueError("Kernel {} not supported. Use \"linear\", \"rbf\", \"poly\", \"sigmoid\", or \"cosine\"".format(kernel))
+
+
+
+@_profiled("LC_MS_kPCA")
+def LC_MS_kPCA(data, labels, mz_bins, RT_bins, thresh=1.0, method="sum", classifier="RF", normalize=None, 
+               tracking=False, kernels=("linear", "rbf", "poly"), gammas=(None,), n_components=(2, 5, 10), 
+               clf_grid=None, cv=5, factor=3, workers=-1, pre_binned=False, random_state=None, get_search=False):
     """Bins the given LC_MSData objects in "data", then uses a parameter 
     gridsearch to find the best hyperparameters for kPCA and the given 
     classifier to predict the labels of the data. Returns the best 
     hyperparameters for the kPCA and the classifier.
-    Supported classifiers are "RF" for Random Forest, and more to come."""
-    raise NotImplementedError("I haven't finished this one yet...")
-    # Get the useful information out of the data
-    N = len(data)
-    r = len(RT_bins)-1
-    m = len(mz_bins)-1
-    binned_data = np.zeros((N, r*m))
-    for i in range(N):
-        if tracking:
-            print(i)
-        binned_data[i] = data[i].bin_data(mz_bins, RT_bins, True, thresh, method, normalize, tracking)
\ No newline at end of file
+    
+    The data are binned once, and the kernel matrix of each kernel and 
+    gamma is computed once from the Gram matrix of the binned data and 
+    saved to a memory-mapped file that the worker processes share. The 
+    search is a successive halving search, which fits every 
+    configuration on a few samples and only keeps the best 1/factor of 
+    them for each larger round, so that bad configurations are dropped 
+    early.
+    
+    Parameters:
+        data (list): A list of LC_MSData objects or an LC_MSStore, or a 
+            numpy array or scipy.sparse matrix if "pre_binned" is True.
+        labels (array): The label of each sample.
+        classifier (str): "RF" for Random Forest, or "SVM" for a support 
+            vector machine.
+        kernels (tuple): The kPCA kernels to try, out of "linear", 
+            "rbf", "poly", "sigmoid", and "cosine".
+        gammas (tuple): The gammas to try for the "rbf", "poly", and 
+            "sigmoid" kernels. None means 1/(number of bins).
+        n_components (tuple): The numbers of kernel principal components 
+            to try.
+        clf_grid (dict): The classifier hyperparameters to try, by 
+            parameter name. Defaults to a small grid for each classifier.
+        cv (int): The number of cross-validation folds.
+        factor (int): The fraction of configurations (1/factor) kept 
+            after each round of the search.
+        workers (int): The number of processes for the search. -1 uses 
+            all of the cores.
+        get_search (bool): Whether or not to also return the fitted 
+            HalvingGridSearchCV object. It is not refit, since the kernel 
+            matrices are deleted when the search ends.
+    
+    Returns:
+        best_params (dict): The best kPCA and classifier hyperparameters, 
+            with "kpca__" and "clf__" prefixes.
+        search (HalvingGridSearchCV): The fitted search."""
+    # Set up the classifier and its default grid
+    if classifier == "RF":
+        clf = RandomForestClassifier(random_state=random_state)
+        default_grid = {"n_estimators": [100, 300], "max_depth": [None, 5]}
+    elif classifier == "SVM":
+        clf = SVC()
+        default_grid = {"C": [0.1, 1, 10]}
+    else:
+        raise ValueError("Classifier {} not supported. Use \"RF\" or \"SVM\"".format(classifier))
+    if clf_grid is None:
+        clf_grid = default_grid
+    
+    # Bin the data once
+    if pre_binned:
+        binned_data = data
+    else:
+        binned_data = LC_MS_binner(data, mz_bins, RT_bins, thresh, method, normalize, tracking, sparse=True)
+    N = binned_data.shape[0]
+    default_gamma = 1/binned_data.shape[1]
+    
+    # Every kernel is a function of the Gram matrix, so the binned data are only needed here
+    _progress(tracking, "Gram matrix")
+    gram = binned_data @ binned_data.T
+    gram = gram.toarray() if sp.issparse(gram) else np.asarray(gram)
+    
+    cache_dir = tempfile.mkdtemp(prefix="lcms_kpca_")
+    try:
+        # Compute and save each kernel matrix once
+        kernel_files = {}
+        kpca_grid = []
+        for kernel in kernels:
+            kernel_gammas = gammas if kernel in ["rbf", "poly", "sigmoid"] else [None]
+            for gamma in kernel_gammas:
+                name = "{},{}".format(kernel, gamma)
+                _progress(tracking, "Kernel %s", name)
+                kernel_files[name] = os.path.join(cache_dir, "kernel_{}.npy".format(len(kernel_files)))
+                K = _kernel_matrix(gram, kernel, default_gamma if gamma is None else gamma)
+                np.save(kernel_files[name], K)
+                kpca_grid.append({"kpca__kernel": [kernel], "kpca__gamma": [gamma]})
+        
+        # Search over every kernel, gamma, number of components, and classifier setting at once
+        param_grid = []
+        for grid in kpca_grid:
+            grid = dict(grid)
+            grid["kpca__n_components"] = list(n_components)
+            grid.update({"clf__"+key:list(values) for key, values in clf_grid.items()})
+            param_grid.append(grid)
+        pipeline = Pipeline([("kpca", _CachedKernelPCA(kernel_files)), ("clf", clf)])
+        search = HalvingGridSearchCV(pipeline, param_grid, factor=factor, cv=cv, n_jobs=workers, 
+                                     random_state=random_state, refit=False, verbose=int(tracking))
+        search.fit(np.arange(N).reshape(-1,1), np.asarray(labels))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    
+    if get_search:
+        return search.best_params_, search
+    return search.best_params_
+
+
+
+if __name__ == "__main__":
+    # Allow the cache to be cleared from the command line
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    clear_parser = subparsers.add_parser("clear-cache", help="Delete the cached LC-MS runs under a directory.")
+    clear_parser.add_argument("path", help="The directory of .csv files whose cache should be cleared.")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    if args.command == "clear-cache":
+        print("Deleted {} cached runs.".format(clear_cache(args.path)))
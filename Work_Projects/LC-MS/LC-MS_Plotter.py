@@ -5,51 +5,79 @@ import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
-# Ask for the data until it's successfully gotten
-while True:
-    try:
-        file_name = input("Full name of file: ")
-        df = pd.read_csv(file_name)
-        assert len(df.columns.values) == 3, "Need three columns: m/z, RT, and intensity"
-    except:
-        print("Invalid file.")
-        restart = input("Try again with a different file name? Y/N ")
-        if restart != "Y":
+# The number of m/z and RT pixels that the points are aggregated into
+GRID_SHAPE = (400, 200)
+# The number of rows read from the file at a time
+CHUNK_SIZE = 1000000
+
+
+def load_points(file_name):
+    """Reads the m/z, RT, and intensity columns of the .csv file as three
+    float32 arrays, a chunk of rows at a time so that the whole file is
+    never held as a DataFrame."""
+    columns = [[], [], []]
+    for chunk in pd.read_csv(file_name, dtype=np.float32, chunksize=CHUNK_SIZE):
+        assert len(chunk.columns.values) == 3, "Need three columns: m/z, RT, and intensity"
+        for i in range(3):
+            columns[i].append(chunk.iloc[:,i].to_numpy())
+    return [np.concatenate(column) for column in columns]
+
+
+def aggregate(mz, RT, counts, mode="max", shape=GRID_SHAPE):
+    """Aggregates the points into a grid of shape m/z pixels by RT pixels,
+    keeping the maximum intensity of each pixel if mode is "max" or the
+    total intensity if mode is "sum". Returns the m/z, RT, and intensity
+    of the center of each pixel that has any points."""
+    mz_edges = np.linspace(mz.min(), mz.max(), shape[0]+1)
+    RT_edges = np.linspace(RT.min(), RT.max(), shape[1]+1)
+    mz_idx = np.clip(np.searchsorted(mz_edges, mz, side="right")-1, 0, shape[0]-1)
+    RT_idx = np.clip(np.searchsorted(RT_edges, RT, side="right")-1, 0, shape[1]-1)
+    flat_idx = mz_idx*shape[1] + RT_idx
+    if mode == "max":
+        grid = np.full(shape[0]*shape[1], -np.inf)
+        np.maximum.at(grid, flat_idx, counts)
+    elif mode == "sum":
+        grid = np.bincount(flat_idx, weights=counts, minlength=shape[0]*shape[1])
+    else:
+        raise ValueError("Mode {} not supported. Use \"points\", \"max\", or \"sum\"".format(mode))
+    # Keep only the pixels with points in them
+    occupied = np.zeros(shape[0]*shape[1], dtype=bool)
+    occupied[flat_idx] = True
+    pixels = np.nonzero(occupied)[0]
+    mz_centers = (mz_edges[:-1] + mz_edges[1:])/2
+    RT_centers = (RT_edges[:-1] + RT_edges[1:])/2
+    return mz_centers[pixels // shape[1]], RT_centers[pixels % shape[1]], grid[pixels]
+
+
+if __name__ == "__main__":
+    # Ask for the data until it's successfully gotten
+    while True:
+        try:
+            file_name = input("Full name of file: ")
+            mz, RT, counts = load_points(file_name)
             break
-    break
-
-# Display the data...
-fig = plt.figure()
-# ... from the m/z angle
-ax = fig.add_subplot(221, projection="3d")
-ax.view_init(elev=0., azim=-90)
-plt.title(r"$\frac{m}{z}$ View")
-ax.scatter(df.iloc[:,0], df.iloc[:,1], df.iloc[:,2])
-plt.xlabel(r"$\frac{m}{z}$")
-plt.ylabel("RT")
-ax.set_zlabel("Counts")
-# ... from the RT angle
-ax = fig.add_subplot(222, projection="3d")
-ax.view_init(elev=0., azim=0)
-plt.title(r"RT View")
-ax.scatter(df.iloc[:,0], df.iloc[:,1], df.iloc[:,2])
-plt.xlabel(r"$\frac{m}{z}$")
-plt.ylabel("RT")
-ax.set_zlabel("Counts")
-# ... and from two other angles
-ax = fig.add_subplot(223, projection="3d")
-ax.view_init(elev=5., azim=-45)
-plt.title(r"Combination View")
-ax.scatter(df.iloc[:,0], df.iloc[:,1], df.iloc[:,2])
-plt.xlabel(r"$\frac{m}{z}$")
-plt.ylabel("RT")
-ax.set_zlabel("Counts")
-# ... and from two other angles
-ax = fig.add_subplot(224, projection="3d")
-ax.view_init(elev=5., azim=-135)
-plt.title(r"Combination View")
-ax.scatter(df.iloc[:,0], df.iloc[:,1], df.iloc[:,2])
-plt.xlabel(r"$\frac{m}{z}$")
-plt.ylabel("RT")
-ax.set_zlabel("Counts")
-plt.show()
\ No newline at end of file
+        except Exception:
+            print("Invalid file.")
+            restart = input("Try again with a different file name? Y/N ")
+            if restart != "Y":
+                raise SystemExit
+
+    # Aggregate the points once for all of the views, unless the raw points are wanted
+    mode = input("Rendering mode (points, max, or sum) [max]: ") or "max"
+    if mode != "points":
+        mz, RT, counts = aggregate(mz, RT, counts, mode)
+
+    # Display the data from the m/z angle, the RT angle, and two other angles
+    fig = plt.figure()
+    views = [(221, 0., -90, r"$\frac{m}{z}$ View"), (222, 0., 0, r"RT View"),
+             (223, 5., -45, r"Combination View"), (224, 5., -135, r"Combination View")]
+    for position, elev, azim, title in views:
+        ax = fig.add_subplot(position, projection="3d")
+        ax.view_init(elev=elev, azim=azim)
+        plt.title(title)
+        # Rasterize the points so that a saved figure is not one vector marker per point
+        ax.scatter(mz, RT, counts, rasterized=True)
+        plt.xlabel(r"$\frac{m}{z}$")
+        plt.ylabel("RT")
+        ax.set_zlabel("Counts")
+    plt.show()
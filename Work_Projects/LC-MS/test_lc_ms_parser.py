@@ -0,0 +1,227 @@
+#test_lc_ms_parser.py
+"""A file for unit testing LC-MS_Parser.py"""
+
+import os
+import sys
+import csv
+import importlib.util
+import pytest
+import numpy as np
+
+# Load LC-MS_Parser.py, whose name is not a valid module name
+spec = importlib.util.spec_from_file_location("LC_MS_Parser", os.path.join(os.path.dirname(os.path.abspath(__file__)), "LC-MS_Parser.py"))
+lcms = importlib.util.module_from_spec(spec)
+# Register the module so that its functions can be pickled for worker processes
+sys.modules[spec.name] = lcms
+spec.loader.exec_module(lcms)
+
+
+def write_run(filename, rng, compounds=30, max_peaks=4):
+    """Writes a random run to a .csv file in the style of parser "1", with a
+    header row for each compound followed by a row for each of its peaks."""
+    with open(filename, "w", newline="") as file:
+        csvwriter = csv.writer(file)
+        for i in range(compounds):
+            RT_start = rng.uniform(0, 29)
+            mz = rng.uniform(100, 900)
+            csvwriter.writerow(["#+ESI MFE Spectrum (rt: {:.3f}-{:.3f} min) Cpd {}: {:.3f}".format(
+                RT_start, RT_start+0.5, i+1, RT_start+0.25)])
+            csvwriter.writerow(["#Point", "X(Thompsons)", "Y(Counts)"])
+            for k in range(rng.integers(1, max_peaks+1)):
+                csvwriter.writerow([k, "{:.4f}".format(mz + 1.003*k), "{:.1f}".format(rng.uniform(1e3, 1e5))])
+
+
+@pytest.fixture
+def run_files(tmp_path):
+    """Writes ten random parser "1" runs and returns their file names."""
+    rng = np.random.default_rng(0)
+    filenames = []
+    for i in range(10):
+        filenames.append(str(tmp_path / "run_{:02d}.csv".format(i)))
+        write_run(filenames[-1], rng)
+    return filenames
+
+
+def test_bin_cache_bounded(run_files):
+    """Makes sure that the binned counts cached by many runs together stay
+    within the budget of the shared bin_cache, and are dropped along with
+    the runs."""
+    budget = lcms.bin_cache.max_bytes
+    lcms.bin_cache.max_bytes = 8*2**20
+    try:
+        runs = [lcms.LC_MSData(filename) for filename in run_files]
+        mz_bins = np.arange(100, 1000, 0.05)
+        RT_bins = np.arange(0, 31, 1.0)
+        binned_data = lcms.LC_MS_binner(runs, mz_bins, RT_bins)
+        assert binned_data.nbytes > 2*lcms.bin_cache.max_bytes
+        assert lcms.bin_cache.n_bytes <= lcms.bin_cache.max_bytes, "failed on cache staying in budget"
+        del runs
+        assert lcms.bin_cache.n_bytes == 0, "failed on dropping deleted runs"
+    finally:
+        lcms.bin_cache.max_bytes = budget
+
+
+def test_LC_MS_bin_engines(run_files):
+    """Makes sure that the loop engine, which is kept as a reference, bins
+    LC-MS runs the same as the numpy, sparse, pyramid and sweep engines."""
+    mz_bins = np.arange(100, 1001, 10.0)
+    RT_bins = np.arange(0, 31, 1.0)
+    for filename in run_files[:3]:
+        run = lcms.LC_MSData(filename)
+        for method in ["sum", "mean"]:
+            for thresh in [1.0, 0.5]:
+                loop = run.bin_data(mz_bins, RT_bins, thresh=thresh, method=method, engine="loop")
+                numpy = run.bin_data(mz_bins, RT_bins, thresh=thresh, method=method, engine="numpy")
+                sparse = run.bin_data(mz_bins, RT_bins, thresh=thresh, method=method, sparse=True)
+                assert np.allclose(loop, numpy), "failed on numpy engine"
+                assert np.allclose(loop, sparse.toarray().ravel()), "failed on sparse engine"
+            sweep = run.bin_data_sweep(mz_bins, RT_bins, [1.0, 0.5], method=method)
+            assert np.allclose(sweep[0], run.bin_data(mz_bins, RT_bins, thresh=1.0, method=method, engine="loop"))
+            assert np.allclose(sweep[1], run.bin_data(mz_bins, RT_bins, thresh=0.5, method=method, engine="loop"))
+        # Bin at a fine resolution once and answer the coarser nested bins from it
+        loop = run.bin_data(mz_bins, RT_bins, engine="loop")
+        run.build_pyramid(np.arange(100, 1001, 1.0), RT_bins)
+        run.bin_cache.clear()
+        assert np.allclose(loop, run.bin_data(mz_bins, RT_bins)), "failed on pyramid"
+
+
+def test_MS_bin_engines(tmp_path):
+    """Makes sure that the loop and numpy engines bin MS spectra the same."""
+    rng = np.random.default_rng(1)
+    for i in range(3):
+        with open(tmp_path / "{:02d} F{}.csv".format(i, i+1), "w", newline="") as file:
+            csvwriter = csv.writer(file)
+            csvwriter.writerow(["X(Thompsons)", "Z", "Y(Counts)"])
+            for mz in np.sort(rng.uniform(100, 900, 200)):
+                csvwriter.writerow(["{:.4f}".format(mz), 1, "{:.1f}".format(rng.uniform(1e3, 1e5))])
+    data = lcms.MSData(str(tmp_path), parser="1")
+    mz_bins = np.arange(100, 901, 5.0)
+    for method in ["sum", "mean"]:
+        for thresh in [1.0, 0.5]:
+            loop = data.bin_data(mz_bins, thresh, method, engine="loop")
+            numpy = data.bin_data(mz_bins, thresh, method, engine="numpy")
+            assert np.allclose(loop, numpy), "failed on numpy engine"
+
+
+def test_PCA_backends():
+    """Makes sure that the exact and randomized PCA backends project a
+    low-rank cohort the same way, up to the signs of the axes, and that the
+    incremental backend, which only approximates the axes, comes close."""
+    rng = np.random.default_rng(2)
+    X = rng.normal(size=(60, 3)) @ (rng.normal(size=(3, 500))*[[10], [5], [2]]) + 0.01*rng.normal(size=(60, 500))
+    exact = lcms.LC_MS_PCA(X, 2, None, None, pre_binned=True, backend="exact")
+    # Set tolerance for error of each backend
+    for backend, tol in [("randomized", 1e-6), ("incremental", 1e-2)]:
+        projected = lcms.LC_MS_PCA(X, 2, None, None, pre_binned=True, backend=backend, chunk_size=20, random_state=0)
+        assert np.allclose(np.abs(exact), np.abs(projected), atol=tol*np.abs(exact).max()), "failed on " + backend
+    # The sparse input of the same data gives the same projection
+    sparse = lcms.LC_MS_PCA(lcms.csr_matrix(X), 2, None, None, pre_binned=True, backend="exact")
+    assert np.allclose(np.abs(exact), np.abs(sparse))
+
+
+def test_store_and_archive(run_files, tmp_path):
+    """Makes sure that runs read back from an LC_MSStore and the rows of an
+    LC_MSArchive match the runs parsed directly."""
+    data_dir = os.path.dirname(run_files[0])
+    mz_bins = np.arange(100, 1001, 10.0)
+    RT_bins = np.arange(0, 31, 1.0)
+    runs = lcms.LC_MS_getter(data_dir, cache=False)
+    store = lcms.LC_MS_getter(data_dir, cache=False, store=str(tmp_path / "store"))
+    assert len(store) == len(runs)
+    binned_data = lcms.LC_MS_binner(runs, mz_bins, RT_bins)
+    assert np.allclose(binned_data, lcms.LC_MS_binner(store, mz_bins, RT_bins)), "failed on store"
+    
+    # Add the runs to an archive in two batches, the second of which fits the axes
+    archive = lcms.LC_MSArchive(str(tmp_path / "archive"), mz_bins, RT_bins, d=2, fit_after=6)
+    names = sorted(os.path.basename(filename) for filename in run_files)
+    assert lcms.LC_MS_ingest(data_dir, archive, filenames=names[:4]) == names[:4]
+    assert len(archive.projection) == 0
+    assert lcms.LC_MS_ingest(data_dir, archive) == names[4:]
+    archive = lcms.LC_MSArchive(str(tmp_path / "archive"))
+    assert np.allclose(archive.binned.toarray(), binned_data), "failed on archive rows"
+    projected = lcms.LC_MS_PCA(binned_data, 2, None, None, pre_binned=True)
+    assert np.allclose(np.abs(archive.projection), np.abs(projected)), "failed on archive projection"
+
+
+def test_parse_cache(run_files):
+    """Makes sure that parse_file reuses a parsed file until it changes."""
+    parsed = lcms.parse_file(run_files[0])
+    assert lcms.parse_file(run_files[0]) is parsed
+    with open(run_files[0], "a", newline="") as file:
+        csv.writer(file).writerow([99, "950.0000", "10.0"])
+    reparsed = lcms.parse_file(run_files[0])
+    assert reparsed is not parsed and len(reparsed.mz) == len(parsed.mz) + 1
+
+
+def test_MFE_combine(run_files, tmp_path):
+    """Makes sure that the sequential and tree alignments agree on files that
+    all hold the same features, and that the long-format table holds the
+    same features as the wide .csv file."""
+    file_list = [run_files[0]]*5
+    outputs = []
+    for align in ["sequential", "tree"]:
+        outfile = str(tmp_path / (align + ".csv"))
+        lcms.MFE_getter(file_list, outfile, combine=True, align=align)
+        outputs.append(np.genfromtxt(outfile, delimiter=",", skip_header=1))
+    assert np.allclose(outputs[0], outputs[1], equal_nan=True), "failed on tree alignment"
+    
+    wide_file = str(tmp_path / "wide.csv")
+    long_file = str(tmp_path / "long.npz")
+    lcms.MFE_getter(run_files[:2], wide_file)
+    lcms.MFE_getter(run_files[:2], long_file, output="npz")
+    wide = np.genfromtxt(wide_file, delimiter=",", skip_header=1)
+    table = lcms.MFE_reader(long_file)
+    for i, filename in enumerate(run_files[:2]):
+        rows = table[table["file"] == filename][lcms._MFE_COLUMNS].to_numpy()
+        assert np.allclose(rows, wide[:len(rows), 10*i:10*i+9], equal_nan=True), "failed on long format"
+
+
+def test_cache_same_names(tmp_path):
+    """Makes sure that runs with the same file name in different
+    subdirectories keep their own cache files, so a second call to
+    LC_MS_getter loads both of them from the cache."""
+    rng = np.random.default_rng(3)
+    for day in ["day1", "day2"]:
+        os.makedirs(tmp_path / day)
+        write_run(str(tmp_path / day / "run.csv"), rng)
+    first = lcms.LC_MS_getter(str(tmp_path))
+    hits = lcms.cache_stats["hits"]
+    second = lcms.LC_MS_getter(str(tmp_path))
+    assert lcms.cache_stats["hits"] == hits + 2, "failed on cache hits"
+    for run_1, run_2 in zip(first, second):
+        assert np.array_equal(run_1.mz, run_2.mz) and np.array_equal(run_1.counts, run_2.counts)
+    assert not np.array_equal(first[0].mz, first[1].mz)
+
+
+def test_workers(run_files, tmp_path):
+    """Makes sure that parsing and combining files in a pool of worker
+    processes gives the same results as doing it in this process."""
+    data_dir = os.path.dirname(run_files[0])
+    serial = lcms.LC_MS_getter(data_dir, cache=False)
+    parallel = lcms.LC_MS_getter(data_dir, cache=False, workers=2)
+    for run_1, run_2 in zip(serial, parallel):
+        assert np.array_equal(run_1.mz, run_2.mz) and np.array_equal(run_1.counts, run_2.counts), "failed on LC_MS_getter"
+    
+    for file_list, combine in [(run_files[:4], False), ([run_files[0]]*4, True)]:
+        outputs = []
+        for workers in [None, 2]:
+            outfile = str(tmp_path / "features_{}_{}.csv".format(combine, workers))
+            lcms.MFE_getter(file_list, outfile, combine=combine, align="tree", workers=workers)
+            outputs.append(np.genfromtxt(outfile, delimiter=",", skip_header=1))
+        assert outputs[0].size > 0 and np.allclose(outputs[0], outputs[1], equal_nan=True), "failed on MFE_getter"
+
+
+def test_MFE_PCA_layouts(run_files, tmp_path):
+    """Makes sure that MFE_PCA reads the same features from the output of
+    MFE_getter as from a hand-trimmed copy with 3 columns per sample that
+    keeps the C12 headers of MFE_getter."""
+    outfile = str(tmp_path / "features.csv")
+    lcms.MFE_getter(run_files[:3], outfile)
+    with open(outfile, "r", newline="") as file:
+        rows = list(csv.reader(file))
+    trimmed_file = str(tmp_path / "trimmed.csv")
+    with open(trimmed_file, "w", newline="") as file:
+        csv.writer(file).writerows([sum([row[10*i:10*i+2] + [""] for i in range(3)], []) for row in rows])
+    full = lcms.MFE_PCA(outfile, 3, 2)
+    trimmed = lcms.MFE_PCA(trimmed_file, 3, 2)
+    assert np.allclose(full[1], trimmed[1]) and full[2] == trimmed[2], "failed on trimmed layout"